@@ -0,0 +1,86 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from src.m2m_api import downloader
+from src.m2m_api.api import M2M
+from src.m2m_api.mock_server import MockConfig, MockM2MServer, mock_dataset
+
+
+def peak_rss_mb():
+    # ru_maxrss est en kilo-octets sous Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_download_benchmark(config, pool_size=downloader.max_threads, backoff_factor=0.1):
+    """
+    Recherche + téléchargement complet contre le serveur M2M local ; retourne les métriques du chemin de téléchargement.
+    """
+    downloader.download_sleep_seconds = 0
+    with MockM2MServer(config) as server, tempfile.TemporaryDirectory() as download_dir:
+        m2m = M2M(username="bench", password="bench", endpoint=server.endpoint, backoff_factor=backoff_factor,
+                  pool_size=pool_size, use_cache=False)  # ne jamais écrire dans le cache de ~/.config/m2m_api
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        scenes = m2m.searchScenes(mock_dataset, maxResults=config.n_scenes)
+        search_seconds = time.perf_counter() - start
+        downloadMeta = m2m.retrieveScenes(mock_dataset, scenes, download_dir=download_dir)
+        elapsed = time.perf_counter() - start
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        files = [meta["local_path"] for meta in downloadMeta.values() if "local_path" in meta and os.path.exists(meta["local_path"])]
+        total_bytes = sum(os.path.getsize(path) for path in files)
+
+        return {
+            "scenes": len(files),
+            "requested_scenes": config.n_scenes,
+            "bytes": total_bytes,
+            "seconds": round(elapsed, 3),
+            "search_seconds": round(search_seconds, 3),
+            "scenes_per_s": round(len(files) / elapsed, 3),
+            "mb_per_s": round(total_bytes / elapsed / 2**20, 2),
+            "peak_python_mb": round(peak_traced / 2**20, 2),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "server": dict(server.state.counters),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du chemin de téléchargement M2M contre un serveur local simulé")
+    parser.add_argument("--scenes", type=int, default=20)
+    parser.add_argument("--payload-mb", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.01, help="secondes ajoutées à chaque requête")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--download-failure-rate", type=float, default=0.0)
+    parser.add_argument("--preparing-delay", type=float, default=0.0)
+    parser.add_argument("--preparing-fraction", type=float, default=0.0)
+    parser.add_argument("--pool-size", type=int, default=downloader.max_threads, help="taille du pool de connexions HTTP")
+    parser.add_argument("--json", help="fichier JSON où écrire le résultat")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    config = MockConfig(
+        n_scenes=args.scenes,
+        payload_size=int(args.payload_mb * 2**20),
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        download_failure_rate=args.download_failure_rate,
+        preparing_delay=args.preparing_delay,
+        preparing_fraction=args.preparing_fraction,
+    )
+    result = run_download_benchmark(config, pool_size=args.pool_size)
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
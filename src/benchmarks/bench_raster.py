@@ -0,0 +1,298 @@
+import argparse
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import ExitStack
+from datetime import date, timedelta
+
+import duckdb
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+# À lancer depuis src/ (mêmes imports que main.py) : python -m benchmarks.bench_raster --size small
+# Le résultat est comparé à benchmarks/baselines/raster_<size>.json, référence locale (non versionnée : les temps
+# dépendent de la machine) créée par --save-baseline. Les écarts de temps et de mémoire sont seulement signalés ;
+# avec --fail-on-regression, seuls les volumes d'E/S (stables d'une machine à l'autre) font échouer la commande.
+from utils.aoi import aoi_grid
+from utils.create_downloads_table import create_downloads_table
+from utils.crop_images import crop_and_store_images, crop_band, crop_center
+from utils.metrics import PipelineMetrics, count_pixels
+from utils.ndvi_storage import create_ndvi_table, store_ndvi_batch
+from utils.qa_mask import QA_CLOUD, QA_DILATED_CLOUD, QA_FILL, qa_valid_mask
+from utils.sensors import default_scaling
+from utils.standardize_and_compute_ndvi import calculate_ndvi, compute_ndvi_windowed, standardize_and_compute_ndvi
+
+BENCH_DIR = os.path.dirname(__file__)
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+# Tailles de scène (lignes, colonnes) ; "full" correspond à une scène Landsat entière
+SCENE_SIZES = {
+    "small": (1000, 1000),
+    "medium": (4000, 4000),
+    "full": (7000, 8000),
+}
+# Scènes synthétiques OLI en UTM 29N, coins calés sur la grille Landsat (15 m + k * 30 m) et recoupant la zone d'étude
+SYNTHETIC_SENSOR = "LC08_L1TP_198054"
+SYNTHETIC_CRS = "EPSG:32629"
+SYNTHETIC_ORIGIN = (430515, 1100715)
+SYNTHETIC_RESOLUTION = 30
+SYNTHETIC_FIRST_DATE = date(2015, 3, 1)
+# Inclinaison de l'emprise utile dans le cadre du GeoTIFF (fraction du côté), pixels hors emprise à 0 comme en Landsat
+FOOTPRINT_SKEW = 0.12
+CLOUD_FRACTION = 0.15
+QA_CLEAR = 1 << 6
+GENERATION_ROWS = 512
+
+# Écart relatif toléré par rapport à la référence avant de signaler une régression
+WALL_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.15
+BYTES_TOLERANCE = 0.10
+# Écarts absolus en dessous desquels une mesure n'est pas comparée (bruit de mesure des étapes très courtes)
+MIN_WALL_DELTA_S = 0.02
+MIN_MEMORY_DELTA_MB = 10
+MIN_BYTES_DELTA = 64 * 1024
+# Mesures qui peuvent faire échouer la comparaison (--fail-on-regression) ; les autres sont signalées seulement
+GATED_METRICS = ("bytes_read", "bytes_written")
+
+
+def scene_id_for(index):
+    acquired = SYNTHETIC_FIRST_DATE + timedelta(days=16 * index)
+    return f"{SYNTHETIC_SENSOR}_{acquired:%Y%m%d}_20200909_02_T1"
+
+
+def write_synthetic_scene(directory, scene_id, shape, seed=0):
+    """
+    Écrit les bandes B4, B5 et QA_PIXEL d'une scène synthétique (uint16, tuilées 256 et compressées DEFLATE
+    comme les produits Collection 2) : végétation lisse plus bruit, nuages en plages, bords hors emprise à 0 / fill.
+    Générée par blocs de lignes : la mémoire ne dépend pas de la taille de la scène.
+    """
+    height, width = shape
+    rng = np.random.default_rng(seed)
+    phase = rng.uniform(0, 2 * math.pi, 3)
+    profile = dict(driver="GTiff", height=height, width=width, count=1, dtype="uint16", crs=SYNTHETIC_CRS,
+                   transform=from_origin(*SYNTHETIC_ORIGIN, SYNTHETIC_RESOLUTION, SYNTHETIC_RESOLUTION),
+                   tiled=True, blockxsize=256, blockysize=256, compress="deflate", predictor=2)
+    paths = {band: os.path.join(directory, f"{scene_id}_{band}.TIF") for band in ("B4", "B5", "QA_PIXEL")}
+
+    with ExitStack() as stack:
+        dst = {band: stack.enter_context(rasterio.open(path, "w", **profile)) for band, path in paths.items()}
+        cols = np.arange(width)
+        for row_off in range(0, height, GENERATION_ROWS):
+            rows = min(GENERATION_ROWS, height - row_off)
+            y = np.arange(row_off, row_off + rows)[:, None] / height
+            x = cols[None, :] / width
+            inside = ((x >= FOOTPRINT_SKEW * (1 - y)) & (x < 1 - FOOTPRINT_SKEW * y)
+                      & (y >= FOOTPRINT_SKEW * x) & (y < 1 - FOOTPRINT_SKEW * (1 - x)))
+            vegetation = 0.5 + 0.4 * np.sin(40 * x + phase[0]) * np.cos(30 * y + phase[1])
+            clouds = np.sin(17 * x + phase[2]) * np.sin(13 * y - phase[2]) > 1 - 2 * CLOUD_FRACTION
+
+            red = 8000 + 4000 * (1 - vegetation) + rng.normal(0, 150, (rows, width))
+            nir = 8000 + 14000 * vegetation + rng.normal(0, 150, (rows, width))
+            qa = np.where(clouds, (1 << QA_CLOUD) | (1 << QA_DILATED_CLOUD), QA_CLEAR)
+            red[~inside] = nir[~inside] = 0
+            qa[~inside] = 1 << QA_FILL
+
+            window = rasterio.windows.Window(0, row_off, width, rows)
+            dst["B4"].write(red.astype(np.uint16), 1, window=window)
+            dst["B5"].write(nir.astype(np.uint16), 1, window=window)
+            dst["QA_PIXEL"].write(qa.astype(np.uint16), 1, window=window)
+    return paths
+
+
+def summarize(metrics):
+    """
+    Meilleure répétition de chaque étape (temps écoulé minimal) ; pic mémoire maximal sur les répétitions.
+    """
+    stages = {}
+    for sample in metrics.samples:
+        if sample.scene_id is not None:
+            continue
+        best = stages.get(sample.stage)
+        peak = max(sample.peak_rss_mb, best["peak_rss_mb"] if best else 0)
+        if best is None or sample.wall_s < best["wall_s"]:
+            best = {
+                "wall_s": sample.wall_s,
+                "cpu_s": sample.cpu_s,
+                "bytes_read": sample.bytes_read,
+                "bytes_written": sample.bytes_written,
+                "pixels": sample.pixels,
+                "mpx_per_s": round(sample.pixels / sample.wall_s / 1e6, 2) if sample.pixels and sample.wall_s else None,
+            }
+        best["peak_rss_mb"] = peak
+        best["status"] = "error" if sample.status == "error" else best.get("status", "ok")
+        stages[sample.stage] = best
+    return stages
+
+
+def run_raster_benchmark(shape, n_scenes=2, repeat=3, workers=1, work_dir=None):
+    """
+    Génère n_scenes scènes synthétiques dans un dossier temporaire, puis mesure (wall, CPU, pic RSS, E/S, pixels) :
+    - chaque chemin critique isolément sur la première scène ;
+    - le pipeline de bout en bout (enregistrement, crop, NDVI par crop et sur la grille commune) dans une base temporaire.
+    """
+    work_dir = tempfile.mkdtemp(prefix="bench_raster_", dir=work_dir)
+    try:
+        extract_dir = os.path.join(work_dir, "extract")
+        os.makedirs(extract_dir)
+        scenes = [scene_id_for(i) for i in range(n_scenes)]
+        logging.info(f"Génération de {n_scenes} scène(s) synthétique(s) {shape[0]}x{shape[1]} dans {work_dir}")
+        bands = [write_synthetic_scene(extract_dir, scene_id, shape, seed=i) for i, scene_id in enumerate(scenes)]
+
+        metrics = PipelineMetrics(run_id="bench_raster")
+        first = bands[0]
+        scaling = (default_scaling("L1", SYNTHETIC_SENSOR[:4]),) * 2
+        grid = aoi_grid()
+
+        for _ in range(repeat):
+            with metrics.stage("read_bands"):
+                with rasterio.open(first["B4"]) as src:
+                    red = src.read(1)
+                with rasterio.open(first["B5"]) as src:
+                    nir = src.read(1)
+                with rasterio.open(first["QA_PIXEL"]) as src:
+                    qa = src.read(1)
+                count_pixels(red.size)
+
+            with metrics.stage("crop_center"):
+                count_pixels(np.ascontiguousarray(crop_center(red)).size)
+
+            with metrics.stage("calculate_ndvi"):
+                ndvi = calculate_ndvi(red, nir, valid=qa_valid_mask(qa), scaling=scaling)
+                count_pixels(ndvi.size)
+            del red, nir, qa
+
+            with metrics.stage("crop_band"):
+                crop_band(first["B4"], os.path.join(work_dir, "crop_B4.TIF"))
+                crop_band(first["B5"], os.path.join(work_dir, "crop_B5.TIF"))
+
+            with metrics.stage("ndvi_windowed"):
+                ndvi, georef = compute_ndvi_windowed(first["B4"], first["B5"], qa_path=first["QA_PIXEL"], scaling=scaling)
+
+            with metrics.stage("duckdb_insert"):
+                con = duckdb.connect(os.path.join(work_dir, "insert.duckdb"))
+                create_ndvi_table(con)
+                store_ndvi_batch(con, [(scenes[0], ndvi, georef)])
+                con.close()
+                count_pixels(ndvi.size)
+            del ndvi
+
+            with metrics.stage("ndvi_aoi_windowed"):
+                ndvi, _ = compute_ndvi_windowed(first["B4"], first["B5"], qa_path=first["QA_PIXEL"], grid=grid,
+                                                scaling=scaling)
+            del ndvi
+
+            db_path = os.path.join(work_dir, "pipeline.duckdb")
+            if os.path.exists(db_path):
+                os.remove(db_path)
+            con = duckdb.connect(db_path)
+            try:
+                with metrics.stage("pipeline"):
+                    with metrics.stage("pipeline_register"):
+                        create_downloads_table(con, extract_path=extract_dir)
+                    with metrics.stage("pipeline_crop"):
+                        crop_and_store_images(con, workers=workers, metrics=metrics,
+                                              output_dir=os.path.join(work_dir, "cropped"))
+                    with metrics.stage("pipeline_ndvi_crop"):
+                        standardize_and_compute_ndvi(con, workers=workers, align="crop", metrics=metrics)
+                    with metrics.stage("pipeline_ndvi_aoi"):
+                        standardize_and_compute_ndvi(con, workers=workers, align="aoi", metrics=metrics)
+            finally:
+                con.close()
+
+        return {
+            "shape": list(shape),
+            "scenes": n_scenes,
+            "repeat": repeat,
+            "workers": workers,
+            "stages": summarize(metrics),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare_to_baseline(result, baseline, wall_tolerance=WALL_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE,
+                        bytes_tolerance=BYTES_TOLERANCE):
+    """
+    Liste des régressions (étape, mesure, référence, valeur) au-delà des tolérances relatives.
+    """
+    for key in ("shape", "scenes", "workers"):
+        if baseline.get(key) != result[key]:
+            logging.warning(f"Référence mesurée avec {key}={baseline.get(key)} (actuel : {result[key]}) : comparaison indicative.")
+
+    regressions = []
+    for stage, current in result["stages"].items():
+        reference = baseline.get("stages", {}).get(stage)
+        if reference is None:
+            continue
+        for metric, tolerance, min_delta in (("wall_s", wall_tolerance, MIN_WALL_DELTA_S),
+                                             ("peak_rss_mb", memory_tolerance, MIN_MEMORY_DELTA_MB),
+                                             ("bytes_read", bytes_tolerance, MIN_BYTES_DELTA),
+                                             ("bytes_written", bytes_tolerance, MIN_BYTES_DELTA)):
+            if current[metric] > reference[metric] * (1 + tolerance) and current[metric] - reference[metric] > min_delta:
+                regressions.append((stage, metric, reference[metric], current[metric]))
+    return regressions
+
+
+def baseline_path(size):
+    return os.path.join(BASELINE_DIR, f"raster_{size}.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark des chemins critiques raster (crop, NDVI, écriture DuckDB)")
+    parser.add_argument("--size", choices=sorted(SCENE_SIZES), default="small")
+    parser.add_argument("--shape", type=int, nargs=2, metavar=("LIGNES", "COLONNES"), help="remplace --size")
+    parser.add_argument("--scenes", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--work-dir", help="dossier des fichiers temporaires (défaut : dossier temporaire du système)")
+    parser.add_argument("--baseline", help="référence JSON à comparer (défaut : benchmarks/baselines/raster_<size>.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="enregistre le résultat comme nouvelle référence")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="code de sortie 1 si les volumes d'E/S dépassent la référence (les temps restent indicatifs)")
+    parser.add_argument("--wall-tolerance", type=float, default=WALL_TOLERANCE)
+    parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE)
+    parser.add_argument("--json", help="fichier JSON où écrire le résultat")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    shape = tuple(args.shape) if args.shape else SCENE_SIZES[args.size]
+    result = run_raster_benchmark(shape, n_scenes=args.scenes, repeat=args.repeat, workers=args.workers,
+                                  work_dir=args.work_dir)
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    reference_path = args.baseline or baseline_path(args.size)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(reference_path)), exist_ok=True)
+        with open(reference_path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Référence enregistrée : {reference_path}")
+        return
+
+    if not os.path.exists(reference_path):
+        if args.baseline:
+            logging.error(f"Référence introuvable : {reference_path}")
+            sys.exit(2)
+        logging.warning(f"Aucune référence pour le profil {args.size} ({reference_path}) : comparaison non effectuée. "
+                        f"Relancer avec --save-baseline pour l'enregistrer.")
+        return
+    with open(reference_path) as f:
+        regressions = compare_to_baseline(result, json.load(f), args.wall_tolerance, args.memory_tolerance)
+    for stage, metric, reference, current in regressions:
+        kind = "RÉGRESSION" if metric in GATED_METRICS else "Écart (indicatif)"
+        print(f"{kind} {stage} {metric} : {reference} -> {current} (+{(current / reference - 1) * 100:.0f} %)")
+    if not regressions:
+        print(f"Aucune régression par rapport à {reference_path}.")
+    if args.fail_on_regression and any(metric in GATED_METRICS for _, metric, _, _ in regressions):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
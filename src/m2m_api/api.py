@@ -1,14 +1,14 @@
 import logging
 import requests
 import json
-import random
-import time
 import os.path as osp
 from pathlib import Path
 from getpass import getpass
 
 from src.m2m_api.filters import Filter
-from src.m2m_api.downloader import download_scenes
+from src.m2m_api.scheduler import DownloadScheduler, poll_max_wait_seconds
+from src.m2m_api import session as m2m_session
+from src.m2m_api import cache as m2m_cache
 
 M2M_ENDPOINT = 'https://m2m.cr.usgs.gov/api/api/json/{}/'
 logging.getLogger('requests').setLevel(logging.WARNING)
@@ -20,13 +20,45 @@ class M2MError(Exception):
 class M2M(object):
     """M2M EarthExplorer API."""
 
-    def __init__(self, username=None, password=None, token=None, version="stable"):
-        self.serviceUrl = M2M_ENDPOINT.format(version)
+    def __init__(self, username=None, password=None, token=None, version="stable", pool_size=m2m_session.pool_size,
+                 timeout=m2m_session.timeout, max_retries=m2m_session.max_retries, backoff_factor=m2m_session.backoff_factor,
+                 endpoint=M2M_ENDPOINT, use_cache=True, cache_ttl=m2m_cache.default_ttl):
+        self.serviceUrl = endpoint.format(version)
         self.apiKey = None
+        self.session = m2m_session.M2MSession(pool_size=pool_size, timeout=timeout, max_retries=max_retries, backoff_factor=backoff_factor)
+        self.cache = m2m_cache.M2MCache(self.serviceUrl, ttl=cache_ttl) if use_cache else None
+        self._datasetNames = None
+        self._permissions = None
+        self._loginFunction = None
         self.authenticate(username, password, token)
-        allDatasets = self.sendRequest('dataset-search')
-        self.datasetNames = [dataset['datasetAlias'] for dataset in allDatasets]
-        self.permissions = self.sendRequest('permissions')
+
+    def cached(self, name, compute, ttl=None):
+        if self.cache is None:
+            return compute()
+        return self.cache.cached(name, compute, ttl)
+
+    def invalidateCache(self, name=None):
+        """Drop one cached entry (e.g. 'dataset-search') or the whole cache for this endpoint."""
+        if self.cache is not None:
+            self.cache.invalidate(name)
+        if name in (None, 'dataset-search'):
+            self._datasetNames = None
+        if name in (None, f'permissions-{self.username}'):
+            self._permissions = None
+
+    @property
+    def datasetNames(self):
+        """Dataset aliases, loaded on first use from the on-disk cache or dataset-search."""
+        if self._datasetNames is None:
+            self._datasetNames = self.cached(
+                'dataset-search', lambda: [dataset['datasetAlias'] for dataset in self.sendRequest('dataset-search')])
+        return self._datasetNames
+
+    @property
+    def permissions(self):
+        if self._permissions is None:
+            self._permissions = self.cached(f'permissions-{self.username}', lambda: self.sendRequest('permissions'))
+        return self._permissions
 
     def authenticate(self, username, password, token):
         config_path = Path(osp.expandvars('~/.config/m2m_api')).expanduser().resolve()
@@ -44,32 +76,53 @@ class M2M(object):
             config['username'] = self.username
 
         if password:
-            self.login(password)
+            self._loginFunction = lambda: self.login(password)
         elif token:
             config.update({'username': self.username, 'token': token})
             json.dump(config, open(config_file, 'w'), indent=4, separators=(',', ': '))
-            self.loginToken(token)
+            self._loginFunction = lambda: self.loginToken(token)
         else:
             token = config.get('token')
             if token is None:
                 option = input("Use password (p) or token (t)? ").lower()
                 if option == "p":
-                    self.login(getpass())
+                    password = getpass()
+                    self._loginFunction = lambda: self.login(password)
                 else:
                     token = input('Enter your token: ')
                     config.update({'username': self.username, 'token': token})
                     json.dump(config, open(config_file, 'w'), indent=4, separators=(',', ': '))
-                    self.loginToken(token)
+                    self._loginFunction = lambda: self.loginToken(token)
             else:
-                self.loginToken(token)
+                self._loginFunction = lambda: self.loginToken(token)
+
+        # Reuse a recent API key instead of logging in again
+        cachedKey = self.cache.get(f'apiKey-{self.username}', ttl=m2m_cache.api_key_ttl) if self.cache else None
+        if cachedKey:
+            self.apiKey = cachedKey
+        else:
+            self._loginFunction()
 
-    def sendRequest(self, endpoint, data={}, max_retries=5):
+    def sendRequest(self, endpoint, data={}):
+        try:
+            return self._sendRequest(endpoint, data)
+        except M2MError as e:
+            # A cached API key may have expired server-side: log in again once and retry
+            if 'AUTH_' not in str(e) or self._loginFunction is None or endpoint in ('login', 'login-token'):
+                raise
+            logging.info('sendRequest - API key rejected, logging in again')
+            self.invalidateCache(f'apiKey-{self.username}')
+            self.apiKey = None
+            self._loginFunction()
+            return self._sendRequest(endpoint, data)
+
+    def _sendRequest(self, endpoint, data={}):
         url = osp.join(self.serviceUrl, endpoint)
         logging.info(f'sendRequest - url = {url}')
         json_data = json.dumps(data)
         headers = {'X-Auth-Token': self.apiKey} if self.apiKey else {}
 
-        response = retry_connect(url, json_data, headers=headers, max_retries=max_retries)
+        response = retry_connect(url, json_data, headers=headers, session=self.session)
         if response is None:
             raise M2MError("No output from service")
 
@@ -91,12 +144,16 @@ class M2M(object):
             raise M2MError('Password not provided')
         loginParameters = {'username': self.username, 'password': password}
         self.apiKey = self.sendRequest('login', loginParameters)
+        if self.cache is not None:
+            self.cache.set(f'apiKey-{self.username}', self.apiKey)
 
     def loginToken(self, token=None):
         if token is None:
             raise M2MError('Token not provided')
         loginParameters = {'username': self.username, 'token': token}
         self.apiKey = self.sendRequest('login-token', loginParameters)
+        if self.cache is not None:
+            self.cache.set(f'apiKey-{self.username}', self.apiKey)
 
     def searchDatasets(self, **args):
         args['processList'] = ['datasetName', 'acquisitionFilter', 'spatialFilter']
@@ -106,7 +163,7 @@ class M2M(object):
     def datasetFilters(self, **args):
         args['processList'] = ['datasetName']
         params = Filter(args)
-        return self.sendRequest('dataset-filters', params)
+        return self.cached(f"dataset-filters-{params.get('datasetName')}", lambda: self.sendRequest('dataset-filters', params))
 
     def searchScenes(self, datasetName, **args):
         if datasetName not in self.datasetNames:
@@ -158,8 +215,16 @@ class M2M(object):
         params = {'label': label}
         self.sendRequest('download-order-remove', params)
 
-    def retrieveScenes(self, datasetName, scenes, filterOptions={}, label='m2m-api_download', download_dir=None):
-        """Méthode corrigée pour accepter un chemin de téléchargement dynamique."""
+    def retrieveScenes(self, datasetName, scenes, filterOptions={}, label='m2m-api_download', download_dir=None,
+                       on_complete=None, max_wait=poll_max_wait_seconds):
+        """Méthode corrigée pour accepter un chemin de téléchargement dynamique.
+
+        Downloads run on a single DownloadScheduler; on_complete(meta) is called as soon as each
+        scene lands, so processing can start before the whole batch is downloaded. Scenes that
+        could not be downloaded or processed by on_complete carry an 'error' entry in the
+        returned metadata (see failed_downloads), including downloads still preparing after
+        max_wait seconds.
+        """
         entityIds = [scene['entityId'] for scene in scenes['results']]
         self.sceneListAdd(label, datasetName, entityIds=entityIds)
         downloadMeta = {}
@@ -186,25 +251,13 @@ class M2M(object):
                     for ds in downloadSearch:
                         downloadMeta[str(ds['downloadId'])] = ds
 
-            if requestResults.get('preparingDownloads'):
-                downloadIds = []
-                for lbl in labels:
-                    requestResultsUpdated = self.downloadRetrieve(lbl)
-                    downloadUpdate = requestResultsUpdated['available'] + requestResultsUpdated['requested']
-                    download_scenes(downloadUpdate, downloadMeta, download_dir=download_dir)
-                    downloadIds += downloadMeta
-
-                while len(downloadIds) < requestedDownloadsCount:
-                    preparingDownloads = requestedDownloadsCount - len(downloadIds)
-                    logging.info(f'M2M.retrieveScenes - {preparingDownloads} downloads are not available. Waiting 10 seconds...')
-                    time.sleep(10)
-                    for lbl in labels:
-                        requestResultsUpdated = self.downloadRetrieve(lbl)
-                        downloadUpdate = requestResultsUpdated['available']
-                        download_scenes(downloadUpdate, downloadMeta, download_dir=download_dir)
-                        downloadIds += downloadUpdate
-            else:
-                download_scenes(requestResults['availableDownloads'], downloadMeta, download_dir=download_dir)
+            scheduler = DownloadScheduler(downloadMeta, download_dir=download_dir, session=self.session, on_complete=on_complete)
+            try:
+                scheduler.submit_all(requestResults.get('availableDownloads', []))
+                if requestResults.get('preparingDownloads'):
+                    scheduler.poll(self, labels, requestedDownloadsCount, max_wait=max_wait)
+            finally:
+                scheduler.shutdown(wait=True)
         else:
             logging.info('M2M.retrieveScenes - No download options found')
 
@@ -218,21 +271,29 @@ class M2M(object):
         if self.sendRequest('logout') is not None:
             raise M2MError("Not able to logout")
         self.apiKey = None
+        if self.cache is not None:
+            self.cache.invalidate(f'apiKey-{self.username}')
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.logout()
-
-def retry_connect(url, json_data, headers={}, max_retries=5, sleep_seconds=2, timeout=600):
-    retries = 0
-    while retries < max_retries:
-        try:
-            response = requests.post(url, json_data, headers=headers, timeout=timeout)
-            return response
-        except requests.exceptions.Timeout:
-            retries += 1
-            logging.info(f'Connection Timeout - retry {retries} of {max_retries}')
-            time.sleep(random.random() * sleep_seconds + 1.0)
-    raise M2MError("Maximum retries exceeded")
+        self.session.close()
+
+def failed_downloads(downloadMeta):
+    """{displayId: error} of the scenes flagged as failed by retrieveScenes."""
+    return {meta.get('displayId', idD): meta['error'] for idD, meta in downloadMeta.items() if meta.get('error')}
+
+def retry_connect(url, json_data, headers={}, timeout=None, session=None):
+    """POST json_data to url through the pooled session.
+
+    Retries are left to the session adapter alone (connection errors and 429/5xx, exponential
+    backoff, max_retries attempts): a second retry loop here would multiply the attempts and the
+    backoff of every call.
+    """
+    session = session or m2m_session.default_session()
+    try:
+        return session.post(url, json_data, headers=headers, timeout=timeout or session.timeout)
+    except requests.exceptions.RequestException as e:
+        raise M2MError(f"Connection error ({type(e).__name__}) after retries: {e}")
 
 def apply_filter(elements, key_filters):
     result = []
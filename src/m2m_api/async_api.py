@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+from src.m2m_api.api import M2M, M2MError
+from src.m2m_api.filters import Filter
+
+page_size = 1000
+max_concurrency = 8
+
+class AsyncM2M(object):
+    """Asyncio M2M EarthExplorer client.
+
+    Wraps an authenticated M2M client: blocking calls run in worker threads through the
+    shared pooled session, and a semaphore bounds the number of requests in flight.
+    """
+
+    def __init__(self, m2m=None, concurrency=max_concurrency, **args):
+        self.m2m = m2m or M2M(**args)
+        self.concurrency = concurrency
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def sendRequest(self, endpoint, data={}):
+        async with self.semaphore:
+            return await asyncio.to_thread(self.m2m.sendRequest, endpoint, data)
+
+    async def datasetFilters(self, **args):
+        args['processList'] = ['datasetName']
+        params = Filter(args)
+        return await self.sendRequest('dataset-filters', params)
+
+    async def searchScenes(self, datasetName, limit=None, **args):
+        """Search scenes and page through every hit concurrently.
+
+        Accepts the same Filter parameters as M2M.searchScenes; maxResults is the page size.
+        The first page gives totalHits, then the remaining startingNumber offsets are fetched
+        concurrently and merged (deduplicated on entityId) into one result set. limit caps
+        the total number of records returned.
+        """
+        if datasetName not in self.m2m.datasetNames:
+            raise M2MError(f"Dataset {datasetName} not one of the available datasets {self.m2m.datasetNames}")
+        args['datasetName'] = datasetName
+        if 'metadataInfo' in args and len(args['metadataInfo']):
+            args['datasetFilters'] = await self.datasetFilters(**args)
+        pageSize = args.get('maxResults') or page_size
+        if limit is not None:
+            pageSize = min(pageSize, limit)
+        args['maxResults'] = pageSize
+        args['processList'] = ['datasetName', 'sceneFilter', 'maxResults', 'startingNumber']
+
+        first = await self.sendRequest('scene-search', Filter(dict(args, startingNumber=1)))
+        totalHits = first['totalHits'] if limit is None else min(first['totalHits'], limit)
+        offsets = range(1 + first['recordsReturned'], totalHits + 1, pageSize) if first['recordsReturned'] else []
+        logging.info(f'AsyncM2M.searchScenes - {totalHits} hits, fetching {len(offsets)} more pages of {pageSize}')
+
+        pages = await asyncio.gather(*(
+            self.sendRequest('scene-search', Filter(dict(args, startingNumber=start))) for start in offsets
+        ))
+
+        results, seen = [], set()
+        for page in [first] + list(pages):
+            for scene in page['results']:
+                if scene['entityId'] not in seen:
+                    seen.add(scene['entityId'])
+                    results.append(scene)
+        results = results[:totalHits]
+
+        scenes = dict(first)
+        scenes.update({'results': results, 'recordsReturned': len(results), 'startingNumber': 1, 'nextRecord': None})
+        return scenes
+
+def search_all_scenes(m2m, datasetName, concurrency=max_concurrency, limit=None, **args):
+    """Blocking helper: run AsyncM2M.searchScenes on an existing M2M client."""
+    return asyncio.run(AsyncM2M(m2m, concurrency=concurrency).searchScenes(datasetName, limit=limit, **args))
@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+import time
+import os.path as osp
+from pathlib import Path
+
+cache_root = '~/.config/m2m_api/cache'
+default_ttl = 24 * 3600
+api_key_ttl = 3600
+
+class M2MCache(object):
+    """On-disk TTL cache for M2M metadata (dataset list, permissions, dataset filters, API key).
+
+    Entries are JSON files under ~/.config/m2m_api/cache/<namespace>/, one per name, where the
+    namespace is derived from the service URL so that different endpoints never share entries.
+    """
+
+    def __init__(self, namespace, ttl=default_ttl, root=cache_root):
+        digest = hashlib.sha1(namespace.encode()).hexdigest()[:16]
+        self.path = Path(osp.expandvars(root)).expanduser().resolve() / digest
+        self.ttl = ttl
+
+    def _file(self, name):
+        safe = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        return self.path / f'{safe}.json'
+
+    def get(self, name, ttl=None):
+        """Return the cached value, or None if missing or older than ttl seconds."""
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            with open(self._file(name)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('created', 0) > ttl:
+            return None
+        return entry.get('value')
+
+    def set(self, name, value):
+        self.path.mkdir(parents=True, exist_ok=True)
+        target = self._file(name)
+        tmp = target.with_suffix('.tmp')
+        # Entries may hold the API key: keep them private to the user
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'created': time.time(), 'value': value}, f)
+        os.replace(tmp, target)
+
+    def cached(self, name, compute, ttl=None):
+        """Return the cached value for name, computing and storing it on a miss."""
+        value = self.get(name, ttl)
+        if value is None:
+            value = compute()
+            self.set(name, value)
+        return value
+
+    def invalidate(self, name=None):
+        """Remove one entry, or every entry of the namespace when name is None."""
+        files = [self._file(name)] if name is not None else list(self.path.glob('*.json'))
+        for f in files:
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
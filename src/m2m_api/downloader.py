@@ -1,4 +1,5 @@
 import concurrent.futures
+import hashlib
 import logging
 import time
 import subprocess
@@ -9,11 +10,15 @@ import os.path as osp
 
 from six.moves.urllib import request as urequest
 
+from src.m2m_api.session import default_session
+
 sleep_seconds = 5
 total_max_retries = 3
 wget = 'wget'
 wget_options = ["--quiet", "--read-timeout=1", "--random-wait", "--progress=dot:giga", "--limit-rate=10m"]
 download_sleep_seconds = 3
+download_chunk_size = 1024 * 1024
+download_timeout = (30, 300)
 
 max_threads = 10
 
@@ -21,49 +26,116 @@ class DownloadError(Exception):
     """Raised when the downloader is unable to retrieve a URL."""
     pass
 
-def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=sleep_seconds):
-    """Download a remote URL to the location local_path with retries."""
+def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=sleep_seconds, checksum=None, hash_algorithm=None,
+                 session=None):
+    """Download a remote URL to the location local_path with retries.
+
+    The body is streamed in download_chunk_size blocks into local_path + '.part', so memory stays constant.
+    On retry, the transfer resumes from the partial file with an HTTP Range request. When checksum
+    (or hash_algorithm) is given, the digest is computed on the fly and checked against checksum.
+    Returns the hex digest, or None when no hashing was requested. Requests go through the
+    pooled session (default_session() when none is given), so connections are reused; its
+    download() path has no adapter retries, so this loop is the only retry layer.
+    """
     dname = osp.basename(local_path)
+    part_path = local_path + '.part'
     logging.info(f'download_url - {dname} - downloading {url} as {local_path}')
     sec = random.random() * download_sleep_seconds
     time.sleep(sec)
 
-    try:
-        r = requests.get(url, stream=True)
-        content_size = int(r.headers.get('content-length', 0))
-        if content_size == 0:
-            logging.error('download_url - content size is 0')
-            raise DownloadError('Content size is 0')
-    except Exception as e:
+    def retry(reason):
         if max_retries > 0:
-            logging.info(f'download_url - {dname} - retrying ({max_retries} retries left)')
+            logging.info(f'download_url - {dname} - {reason}, retrying ({max_retries} retries left)')
             time.sleep(sleep_seconds)
-            return download_url(url, local_path, max_retries=max_retries-1, sleep_seconds=sleep_seconds)
+            return download_url(url, local_path, max_retries=max_retries-1, sleep_seconds=sleep_seconds,
+                                checksum=checksum, hash_algorithm=hash_algorithm, session=session)
         logging.error(f'download_url - {dname} - no more retries available')
-        raise DownloadError(f'Failed to find file {url}')
+        raise DownloadError(f'Failed to download file {url}: {reason}')
 
-    remove(local_path)
-    logging.info(f'download_url - {dname} - starting download...')
+    offset = osp.getsize(part_path) if osp.isfile(part_path) else 0
+    hasher = hashlib.new(hash_algorithm or guess_hash_algorithm(checksum)) if checksum or hash_algorithm else None
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
 
-    with open(ensure_dir(local_path), 'wb') as f:
-        f.write(r.raw.read())
+    try:
+        r = (session or default_session()).download(url, stream=True, headers=headers, timeout=download_timeout)
+    except requests.exceptions.RequestException as e:
+        return retry(f'request failed ({e})')
+
+    with r:
+        if r.status_code == 416 and offset:
+            # Range past the end: the partial file may already hold the whole body
+            content_size = content_range_total(r.headers.get('content-range'))
+            if content_size != offset:
+                remove(part_path)
+                return retry('invalid partial file')
+            if hasher is not None:
+                hasher = file_hasher(part_path, hasher.name)
+        elif r.status_code not in (200, 206):
+            return retry(f'HTTP status {r.status_code}')
+        else:
+            if r.status_code == 200 and offset:
+                logging.info(f'download_url - {dname} - server ignored range request, restarting from byte 0')
+                offset = 0
+            content_size = offset + int(r.headers.get('content-length', 0))
+            if content_size == 0:
+                logging.error('download_url - content size is 0')
+                return retry('content size is 0')
+
+            logging.info(f'download_url - {dname} - starting download at byte {offset} of {content_size}...')
+            if hasher is not None and offset:
+                # Resume: seed the running hash with the bytes already on disk
+                hasher = file_hasher(part_path, hasher.name)
+            try:
+                with open(ensure_dir(part_path), 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=download_chunk_size):
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+            except requests.exceptions.RequestException as e:
+                return retry(f'transfer interrupted at byte {osp.getsize(part_path)} ({e})')
+
+    file_size = osp.getsize(part_path)
+    if int(file_size) != int(content_size):
+        logging.warning(f'download_url - {dname} - wrong file size {file_size} != {content_size}')
+        if file_size > content_size:
+            remove(part_path)
+        return retry('wrong file size')
+
+    digest = hasher.hexdigest() if hasher is not None else None
+    if checksum and digest.lower() != checksum.lower():
+        remove(part_path)
+        return retry(f'checksum mismatch {digest} != {checksum}')
 
-    file_size = osp.getsize(local_path)
-    if int(file_size) != int(content_size) and content_size > 0:
-        logging.warning(f'download_url - {dname} - wrong file size, retrying, {max_retries} retries left')
-        if max_retries > 0:
-            time.sleep(sleep_seconds)
-            return download_url(url, local_path, max_retries=max_retries-1, sleep_seconds=sleep_seconds)
-        remove(local_path)
-        raise DownloadError(f'Failed to download file {url}')
+    remove(local_path)
+    os.replace(part_path, local_path)
 
     info_path = local_path + '.size'
     with open(ensure_dir(info_path), 'w') as f:
         f.write(str(content_size))
 
     logging.info(f'download_url - {dname} - success download')
+    return digest
 
-def download_scenes(downloads, downloadMeta, download_dir=None):
+def content_range_total(content_range):
+    """Total size from a 'bytes start-end/total' or 'bytes */total' Content-Range header."""
+    try:
+        return int(content_range.rsplit('/', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def guess_hash_algorithm(checksum):
+    """Pick the hash algorithm matching the length of a hex digest."""
+    return {32: 'md5', 40: 'sha1', 64: 'sha256'}.get(len(checksum), 'md5')
+
+def file_hasher(path, algorithm='md5'):
+    """Return a hash object fed with the content of path, read in download_chunk_size blocks."""
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b''):
+            h.update(chunk)
+    return h
+
+def download_scenes(downloads, downloadMeta, download_dir=None, session=None):
     """Download all scenes using multithreading."""
     logging.info(f'download_scenes - downloading {len(downloads)} scenes')
 
@@ -82,7 +154,7 @@ def download_scenes(downloads, downloadMeta, download_dir=None):
                 if available_locally(local_path):
                     logging.info(f'downloadScenes - file {local_path} is already available')
                 else:
-                    future = executor.submit(download_url, url, local_path)
+                    future = executor.submit(download_url, url, local_path, session=session)
                     futures.append(future)
                 downloadMeta[idD].update({'url': url, 'local_path': local_path})
             else:
@@ -27,6 +27,9 @@ class Filter(dict):
             if elem == 'maxResults':
                 maxResults = args.get(elem,None)
                 params.update(self.maxResults(maxResults))
+            elif elem == 'startingNumber':
+                startingNumber = args.get(elem,None)
+                params.update(self.startingNumber(startingNumber))
             elif elem == 'datasetName':
                 datasetName = args.get(elem,None)
                 params.update(self.datasetName(datasetName))
@@ -78,6 +81,14 @@ class Filter(dict):
             'maxResults': maxResults
         }
 
+    @staticmethod
+    def startingNumber(startingNumber):
+        if startingNumber is None:
+            return {}
+        return {
+            'startingNumber': startingNumber
+        }
+
     @staticmethod
     def datasetName(datasetName):
         if datasetName is None:
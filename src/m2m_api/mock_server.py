@@ -0,0 +1,291 @@
+import json
+import random
+import tarfile
+import threading
+import time
+import logging
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+mock_dataset = 'landsat_tm_c2_l1'
+stream_chunk_size = 1024 * 1024
+
+class MockConfig(object):
+    """Behaviour of the local M2M stand-in."""
+
+    def __init__(self, n_scenes=20, payload_size=10 * 1024 * 1024, latency=0.0, failure_rate=0.0,
+                 download_failure_rate=0.0, preparing_delay=0.0, preparing_fraction=0.0, seed=0):
+        self.n_scenes = n_scenes
+        self.payload_size = payload_size
+        # Seconds added to every API call and download
+        self.latency = latency
+        # Probability of a 503 answer on any request
+        self.failure_rate = failure_rate
+        # Probability of cutting a download halfway through the body
+        self.download_failure_rate = download_failure_rate
+        # Seconds before a preparing download becomes available, and share of downloads that start as preparing
+        self.preparing_delay = preparing_delay
+        self.preparing_fraction = preparing_fraction
+        self.seed = seed
+
+def synthetic_acquisition_date(i):
+    return date(2000, 1, 1) + timedelta(days=16 * i)
+
+def synthetic_display_id(i):
+    return f"LT05_L1TP_198054_{synthetic_acquisition_date(i):%Y%m%d}_20200907_02_T1"
+
+class SyntheticTar(object):
+    """Valid single-member tar of payload_size zero bytes, generated on the fly (never held in memory)."""
+
+    def __init__(self, displayId, payload_size):
+        info = tarfile.TarInfo(f'{displayId}_B3.TIF')
+        info.size = payload_size
+        info.mtime = 0
+        self.header = info.tobuf(format=tarfile.USTAR_FORMAT)
+        padding = -payload_size % tarfile.BLOCKSIZE
+        self.size = len(self.header) + payload_size + padding + 2 * tarfile.BLOCKSIZE
+
+    def iter_range(self, start, end, chunk_size=stream_chunk_size):
+        """Yield the bytes in [start, end)."""
+        pos = start
+        while pos < end:
+            stop = min(end, pos + chunk_size)
+            if pos < len(self.header):
+                chunk = self.header[pos:stop] + bytes(max(0, stop - len(self.header)))
+            else:
+                chunk = bytes(stop - pos)
+            yield chunk
+            pos = stop
+
+class MockState(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.scenes = [{'entityId': f'LT5198054{i:07d}', 'displayId': synthetic_display_id(i), 'cloudCover': 5.0,
+                        'temporalCoverage': {'startDate': f'{synthetic_acquisition_date(i)} 00:00:00'}}
+                       for i in range(config.n_scenes)]
+        self.byEntity = {scene['entityId']: scene for scene in self.scenes}
+        self.lists = {}
+        self.downloads = {}
+        self.labels = {}
+        self.counters = {'api_requests': 0, 'downloads': 0, 'failures': 0, 'bytes_served': 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counters[key] += n
+
+    def fail(self):
+        with self.lock:
+            return self.random.random() < self.config.failure_rate
+
+class MockM2MHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(f'MockM2M - {format % args}')
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        state = self.state
+        state.count('api_requests')
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length) if length else b''
+        time.sleep(state.config.latency)
+        if state.fail():
+            state.count('failures')
+            return self.send_json(503, {'errorCode': 'UNAVAILABLE', 'errorMessage': 'Injected failure'})
+
+        endpoint = self.path.rstrip('/').rsplit('/', 1)[-1]
+        data = json.loads(raw) if raw else {}
+        handler = getattr(self, 'api_' + endpoint.replace('-', '_'), None)
+        if handler is None:
+            return self.send_json(404, {'errorCode': 'UNKNOWN_ENDPOINT', 'errorMessage': endpoint, 'data': None})
+        self.send_json(200, {'errorCode': None, 'errorMessage': None, 'data': handler(data)})
+
+    def api_login(self, data):
+        return 'mock-api-key'
+
+    api_login_token = api_login
+
+    def api_logout(self, data):
+        return None
+
+    def api_permissions(self, data):
+        return ['download', 'order']
+
+    def api_dataset_search(self, data):
+        return [{'datasetAlias': mock_dataset, 'collectionName': 'Mock Landsat'}]
+
+    def api_dataset_filters(self, data):
+        return []
+
+    def api_scene_search(self, data):
+        scenes = self.state.scenes
+        acquisitionFilter = data.get('sceneFilter', {}).get('acquisitionFilter')
+        if acquisitionFilter:
+            start = acquisitionFilter.get('start', '0000-00-00').replace('-', '')
+            end = acquisitionFilter.get('end', '9999-99-99').replace('-', '')
+            scenes = [scene for scene in scenes if start <= scene['displayId'].split('_')[3] <= end]
+        start = data.get('startingNumber', 1)
+        maxResults = data.get('maxResults', 100)
+        results = scenes[start - 1:start - 1 + maxResults]
+        nextRecord = start + len(results)
+        return {'results': results, 'recordsReturned': len(results), 'totalHits': len(scenes),
+                'startingNumber': start, 'nextRecord': nextRecord if nextRecord <= len(scenes) else None}
+
+    def api_scene_list_add(self, data):
+        with self.state.lock:
+            self.state.lists.setdefault(data['listId'], []).extend(data.get('entityIds', []))
+        return None
+
+    def api_scene_list_get(self, data):
+        return [{'entityId': entityId} for entityId in self.state.lists.get(data['listId'], [])]
+
+    def api_scene_list_remove(self, data):
+        self.state.lists.pop(data['listId'], None)
+        return None
+
+    def api_download_options(self, data):
+        entityIds = self.state.lists.get(data.get('listId'), data.get('entityIds', []))
+        return [{'entityId': entityId, 'id': f'P{entityId}', 'downloadSystem': 'dds', 'available': True}
+                for entityId in entityIds]
+
+    def api_download_request(self, data):
+        state = self.state
+        label = data.get('label')
+        available, preparing = [], []
+        with state.lock:
+            for download in data['downloads']:
+                downloadId = len(state.downloads) + 1
+                preparingDownload = state.random.random() < state.config.preparing_fraction
+                scene = state.byEntity[download['entityId']]
+                state.downloads[downloadId] = {
+                    'downloadId': downloadId,
+                    'entityId': scene['entityId'],
+                    'displayId': scene['displayId'],
+                    'label': label,
+                    'readyAt': time.time() + (state.config.preparing_delay if preparingDownload else 0.0),
+                }
+                state.labels.setdefault(label, []).append(downloadId)
+                entry = {'downloadId': downloadId, 'eulaCode': None, 'url': self.url_for(downloadId)}
+                (preparing if preparingDownload else available).append(entry)
+        return {'availableDownloads': available, 'preparingDownloads': [dict(p, url=None) for p in preparing],
+                'duplicateProducts': {}, 'failed': []}
+
+    def api_download_search(self, data):
+        label = data.get('label')
+        ids = self.state.labels.get(label, []) if label else list(self.state.downloads)
+        return [{k: v for k, v in self.state.downloads[i].items() if k != 'readyAt'} for i in ids]
+
+    def api_download_retrieve(self, data):
+        now = time.time()
+        available, requested = [], []
+        for downloadId in self.state.labels.get(data.get('label'), []):
+            download = self.state.downloads[downloadId]
+            if download['readyAt'] <= now:
+                available.append({'downloadId': downloadId, 'url': self.url_for(downloadId), 'statusText': 'Available'})
+            else:
+                requested.append({'downloadId': downloadId, 'url': None, 'statusText': 'Preparing'})
+        return {'available': available, 'requested': requested}
+
+    def api_download_order_remove(self, data):
+        return None
+
+    def url_for(self, downloadId):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/download/{downloadId}'
+
+    def do_GET(self):
+        state = self.state
+        time.sleep(state.config.latency)
+        if not self.path.startswith('/download/'):
+            return self.send_json(404, {'errorCode': 'NOT_FOUND', 'errorMessage': self.path})
+        download = state.downloads.get(int(self.path.rsplit('/', 1)[-1]))
+        if download is None or download['readyAt'] > time.time():
+            return self.send_json(404, {'errorCode': 'NOT_READY', 'errorMessage': self.path})
+        if state.fail():
+            state.count('failures')
+            return self.send_json(503, {'errorCode': 'UNAVAILABLE', 'errorMessage': 'Injected failure'})
+
+        payload = SyntheticTar(download['displayId'], state.config.payload_size)
+        start = 0
+        rangeHeader = self.headers.get('Range')
+        if rangeHeader:
+            start = int(rangeHeader.split('=', 1)[1].split('-', 1)[0])
+            if start >= payload.size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{payload.size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send_response(206 if rangeHeader else 200)
+        self.send_header('Content-Type', 'application/x-tar')
+        self.send_header('Content-Length', str(payload.size - start))
+        if rangeHeader:
+            self.send_header('Content-Range', f'bytes {start}-{payload.size - 1}/{payload.size}')
+        self.end_headers()
+
+        end = payload.size
+        with state.lock:
+            cut = state.random.random() < state.config.download_failure_rate
+        if cut:
+            end = start + (payload.size - start) // 2
+            state.count('failures')
+        for chunk in payload.iter_range(start, end):
+            self.wfile.write(chunk)
+            state.count('bytes_served', len(chunk))
+        state.count('downloads')
+        if cut:
+            self.close_connection = True
+
+class MockM2MServer(object):
+    """Local M2M API stand-in running on localhost in a background thread.
+
+    Usage:
+        with MockM2MServer(MockConfig(n_scenes=5)) as server:
+            m2m = M2M(username='mock', password='mock', endpoint=server.endpoint)
+    """
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or MockConfig()
+        self.httpd = ThreadingHTTPServer((host, port), MockM2MHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = MockState(self.config)
+        self.thread = None
+
+    @property
+    def state(self):
+        return self.httpd.state
+
+    @property
+    def endpoint(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/api/api/json/{{}}/'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
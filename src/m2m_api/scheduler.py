@@ -0,0 +1,131 @@
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+import os.path as osp
+
+from src.m2m_api.downloader import download_url, available_locally, max_threads
+
+default_download_dir = '../data/raw/landsat'
+poll_min_seconds = 2
+poll_max_seconds = 60
+poll_backoff = 1.5
+# Give up on downloads that still have no URL after this many seconds
+poll_max_wait_seconds = 2 * 3600
+
+class DownloadScheduler(object):
+    """Persistent download scheduler.
+
+    One long-lived thread pool downloads scenes as soon as their URL is ready. Downloads are
+    de-duplicated by downloadId, preparing downloads are polled with adaptive exponential
+    backoff, and every finished scene is handed to on_complete (and to the completed queue)
+    as soon as it lands, without waiting for the rest of the batch. Failed scenes (download or
+    on_complete) are collected in failed and flagged with an 'error' entry in their metadata.
+    """
+
+    def __init__(self, downloadMeta, download_dir=None, session=None, max_workers=max_threads, on_complete=None):
+        self.downloadMeta = downloadMeta
+        self.download_dir = download_dir or default_download_dir
+        self.session = session
+        self.on_complete = on_complete
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.completed = queue.Queue()
+        self.scheduled = set()
+        self.futures = []
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def submit(self, download):
+        """Schedule one download-retrieve entry; return True if it was new."""
+        url = download.get('url')
+        idD = str(download['downloadId'])
+        if not url:
+            return False
+        with self._lock:
+            if idD in self.scheduled:
+                return False
+            if idD not in self.downloadMeta:
+                logging.warning(f'DownloadScheduler - scene ID {idD} not found in metadata')
+                return False
+            self.scheduled.add(idD)
+
+        meta = self.downloadMeta[idD]
+        local_path = osp.join(self.download_dir, meta['displayId'] + '.tar')
+        meta.update({'url': url, 'local_path': local_path})
+        self.futures.append(self.executor.submit(self._download, idD, url, local_path))
+        return True
+
+    def submit_all(self, downloads):
+        return sum(self.submit(download) for download in downloads)
+
+    def _download(self, idD, url, local_path):
+        if available_locally(local_path):
+            logging.info(f'DownloadScheduler - file {local_path} is already available')
+        else:
+            try:
+                download_url(url, local_path, session=self.session)
+            except Exception as e:
+                self.fail(idD, e)
+                return
+        meta = self.downloadMeta[idD]
+        self.completed.put(meta)
+        logging.info(f'DownloadScheduler - {len(self.scheduled) - self.pending()} downloads finished')
+        if self.on_complete is not None:
+            try:
+                self.on_complete(meta)
+            except Exception as e:
+                self.fail(idD, e, 'on_complete failed')
+
+    def fail(self, idD, error, what='failed'):
+        """Record a failed scene, in failed and as an 'error' entry of its metadata."""
+        logging.error(f'DownloadScheduler - {idD} {what}: {error}')
+        with self._lock:
+            self.failed[idD] = error
+            if idD in self.downloadMeta:
+                self.downloadMeta[idD]['error'] = f'{what}: {error}'
+
+    def pending(self):
+        return sum(not future.done() for future in self.futures)
+
+    def poll(self, m2m, labels, expected, min_interval=poll_min_seconds, max_interval=poll_max_seconds,
+             backoff=poll_backoff, max_wait=poll_max_wait_seconds):
+        """Poll download-retrieve until expected downloads have been scheduled.
+
+        The interval starts at min_interval, grows by backoff while nothing new becomes
+        available and is reset as soon as new URLs show up. After max_wait seconds the
+        downloads still preparing are recorded as failed and their IDs are returned.
+        """
+        interval = min_interval
+        start = time.time()
+        while len(self.scheduled) < expected:
+            new = 0
+            for lbl in labels:
+                retrieved = m2m.downloadRetrieve(lbl)
+                new += self.submit_all(retrieved['available'] + retrieved['requested'])
+            if len(self.scheduled) >= expected:
+                break
+            if max_wait is not None and time.time() - start > max_wait:
+                pending = [idD for idD in self.downloadMeta if idD not in self.scheduled]
+                logging.warning(f'DownloadScheduler - giving up after {max_wait}s, {expected - len(self.scheduled)} '
+                                f'downloads still preparing: {pending}')
+                for idD in pending:
+                    self.fail(idD, f'no download URL after {max_wait}s', 'still preparing')
+                return pending
+            interval = min_interval if new else min(interval * backoff, max_interval)
+            logging.info(f'DownloadScheduler - {expected - len(self.scheduled)} downloads are not available. Waiting {interval:.1f} seconds...')
+            time.sleep(interval)
+        return []
+
+    def iter_completed(self):
+        """Yield scene metadata as downloads land, until every scheduled download is done."""
+        while True:
+            try:
+                yield self.completed.get(timeout=0.5)
+            except queue.Empty:
+                if not self.pending() and self.completed.empty():
+                    return
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        logging.info(f'DownloadScheduler - all downloads finished ({len(self.failed)} failed)')
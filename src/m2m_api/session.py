@@ -0,0 +1,82 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+pool_size = 10
+timeout = (30, 600)
+max_retries = 5
+backoff_factor = 1.0
+status_forcelist = (429, 500, 502, 503, 504)
+
+class M2MSession(object):
+    """Thread-safe pooled HTTP session shared by the M2M client and the downloader.
+
+    Each thread gets its own requests.Session (cookies and headers are not shared), but all of
+    them are mounted on a single HTTPAdapter, so TCP/TLS connections are kept alive and reused
+    across threads. The adapter retries connection errors and 429/5xx responses with exponential
+    backoff. Downloads (download()) go through a second pooled adapter without retries: download_url
+    already retries them itself, resuming from the partial file, and the two layers would multiply.
+    """
+
+    def __init__(self, pool_size=pool_size, timeout=timeout, max_retries=max_retries,
+                 backoff_factor=backoff_factor, status_forcelist=status_forcelist):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=status_forcelist,
+            allowed_methods=frozenset(['GET', 'POST']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.download_adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self._local = threading.local()
+
+    def _thread_session(self, name, adapter):
+        session = getattr(self._local, name, None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            setattr(self._local, name, session)
+        return session
+
+    @property
+    def session(self):
+        return self._thread_session('session', self.adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def download(self, url, **kwargs):
+        """GET without adapter-level retries, for callers that retry (and resume) on their own."""
+        kwargs.setdefault('timeout', self.timeout)
+        return self._thread_session('download_session', self.download_adapter).get(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+        self.download_adapter.close()
+
+_default_session = None
+_default_lock = threading.Lock()
+
+def default_session():
+    """Process-wide session used when no explicit session is passed."""
+    global _default_session
+    with _default_lock:
+        if _default_session is None:
+            _default_session = M2MSession()
+        return _default_session
@@ -1,11 +1,21 @@
 import os
+import sys
+import json
 import logging
+import argparse
+import subprocess
 import duckdb
 
 # Importer les modules du pipeline
-from utils.create_downloads_table import create_downloads_table
-from utils.crop_images import crop_and_store_images
+from utils.extraction_images import EXTRACT_DIR, RAW_DIR, extract_images
+from utils.create_downloads_table import create_downloads_table, select_scene_ids
+from utils.crop_images import CROPPED_DIR, crop_and_store_images
 from utils.standardize_and_compute_ndvi import standardize_and_compute_ndvi
+from utils.ndvi_cube import CUBE_DIR, append_to_cube
+from utils.ndvi_export import NDVI_TIF_DIR, export_ndvi_cogs
+from utils.ndvi_render import PNG_DIR, plot_ndvi_timeseries, render_ndvi_maps
+from utils.metrics import PipelineMetrics
+from utils.pipeline_dag import STAGE_PARALLELISM, Stage, run_stages, select_stages
 
 # === Configuration du Logging ===
 logging.basicConfig(
@@ -17,46 +27,208 @@ logging.basicConfig(
 # === Définition des chemins ===
 # Point de départ = src/
 BASE_DIR = os.path.dirname(__file__)
+PROJECT_DIR = os.path.dirname(os.path.abspath(BASE_DIR))  # ➔ racine du dépôt (imports src.*)
 DB_DIR = os.path.join(BASE_DIR, "bdd")       # ➔ src/bdd/
 DB_PATH = os.path.join(DB_DIR, "ndvi.duckdb") # ➔ src/bdd/ndvi.duckdb
 
+# Nombre de processus pour le crop et le NDVI (1 = séquentiel)
+WORKERS = int(os.environ.get("NDVI_WORKERS", 1))
+# Mode incrémental : conserver la base et ne traiter que les scènes nouvelles ou modifiées
+INCREMENTAL = os.environ.get("NDVI_INCREMENTAL", "0") == "1"
+# Mode fusionné : crop et NDVI en une seule lecture, sans GeoTIFF croppés intermédiaires
+FUSED = os.environ.get("NDVI_FUSED", "0") == "1"
+# Alignement des scènes : "aoi" (reprojection sur la grille de la zone d'étude) ou "crop" (fenêtre centrale)
+ALIGN = os.environ.get("NDVI_ALIGN", "aoi")
+# Cube temporel (time, y, x) : ajout des nouvelles dates après le calcul du NDVI
+CUBE = os.environ.get("NDVI_CUBE", "0") == "1"
+# Export des cartes NDVI en Cloud-Optimized GeoTIFF (data/ndvi_tif)
+COG = os.environ.get("NDVI_COG", "0") == "1"
+# Rendu des vignettes PNG et du graphique temporel (data/ndvi_png)
+RENDER = os.environ.get("NDVI_RENDER", "0") == "1"
+# Mesures par étape et par scène : toujours enregistrées dans pipeline_metrics, et en JSON lines si un chemin est donné
+METRICS_JSONL = os.environ.get("NDVI_METRICS_JSONL") or None
+
+# === Graphe des étapes ===
+def download_scenes(raw_dir=RAW_DIR, extract_dir=EXTRACT_DIR):
+    """
+    Recherche et téléchargement M2M (extraction au fil de l'eau), lancés depuis la racine du dépôt :
+    telechargement_scenes utilise les imports src.* et nécessite des identifiants USGS.
+    """
+    subprocess.run([sys.executable, "-m", "src.utils.telechargement_scenes",
+                    "--download-dir", os.path.abspath(raw_dir), "--extract-dir", os.path.abspath(extract_dir)],
+                   cwd=PROJECT_DIR, check=True)
+
+
+def build_stages(workers=WORKERS, incremental=INCREMENTAL, content_hash=False, fused=FUSED, in_place=False, align=ALIGN,
+                 cog=COG, replace=True, scene_filter=None, metrics=None, raw_dir=RAW_DIR, extract_dir=EXTRACT_DIR,
+                 cropped_dir=CROPPED_DIR):
+    """
+    Étapes du pipeline et leurs dépendances : download -> extract -> register -> crop -> ndvi -> cube / cog / maps / timeseries.
+    scene_filter(con) retourne les scènes à traiter (None = toutes) ; il est évalué au lancement de chaque étape,
+    une fois la table downloads à jour.
+    """
+    scene_filter = scene_filter or (lambda con: None)
+    cropped = align == "crop" and not fused
+    ndvi_inputs = ("table:downloads", "table:cropped_images") if cropped else ("table:downloads",)
+
+    def extract(con):
+        for archive, error in extract_images(raw_dir=raw_dir, extract_dir=extract_dir).items():
+            if metrics is not None:
+                metrics.record_error(archive, error)
+
+    stages = [
+        Stage("download", lambda con: download_scenes(raw_dir, extract_dir), outputs=(raw_dir, extract_dir)),
+        Stage("extract", extract, ("download",), (raw_dir,), (extract_dir,)),
+        Stage("register",
+              lambda con: create_downloads_table(con, incremental=incremental, content_hash=content_hash, in_place=in_place,
+                                                 extract_path=extract_dir, raw_path=raw_dir, replace=replace),
+              ("extract",), (raw_dir if in_place else extract_dir,), ("table:downloads",)),
+        Stage("crop",
+              lambda con: crop_and_store_images(con, workers=workers, incremental=incremental, metrics=metrics,
+                                                output_dir=cropped_dir, scene_ids=scene_filter(con), replace=replace,
+                                                content_hash=content_hash),
+              ("register",), ("table:downloads",), ("table:cropped_images", cropped_dir), exclusive=True),
+        Stage("ndvi",
+              lambda con: standardize_and_compute_ndvi(con, workers=workers, incremental=incremental, fused=fused,
+                                                       align=align, write_geotiff=cog, metrics=metrics,
+                                                       scene_ids=scene_filter(con), replace=replace,
+                                                       content_hash=content_hash),
+              ("register", "crop"), ndvi_inputs, ("table:standardized_ndvi", "table:ndvi_stats"), exclusive=True),
+        Stage("cube", lambda con: append_to_cube(con, replace=replace),
+              ("ndvi",), ("table:standardized_ndvi",), (CUBE_DIR,)),
+        # Réexport depuis la base ; avec cog=True, le calcul du NDVI écrit déjà les COG pendant que le tableau est en mémoire
+        Stage("cog", lambda con: export_ndvi_cogs(con, scene_filter(con)),
+              ("ndvi",), ("table:standardized_ndvi",), (NDVI_TIF_DIR,)),
+        Stage("maps", lambda con: render_ndvi_maps(con, scene_filter(con), workers=workers, metrics=metrics),
+              ("ndvi", "cog"), ("table:standardized_ndvi",), (PNG_DIR,), exclusive=workers > 1),
+        Stage("timeseries", lambda con: plot_ndvi_timeseries(con),
+              ("ndvi",), ("table:ndvi_stats",), (PNG_DIR,)),
+    ]
+    return {stage.name: stage for stage in stages}
+
+
 # === Fonction principale ===
-def run_pipeline():
-    logging.info("=== Pipeline NDVI : Démarrage ===")
+def run_pipeline(workers=WORKERS, incremental=INCREMENTAL, content_hash=False, fused=FUSED, keep_cropped=False, in_place=False,
+                 cube=CUBE, align=ALIGN, cog=COG, render=RENDER, metrics_jsonl=METRICS_JSONL, download=False, extract=False,
+                 only=None, start=None, scene_ids=None, sensors=None, date_from=None, date_to=None, db_path=DB_PATH,
+                 raw_dir=RAW_DIR, extract_dir=EXTRACT_DIR, cropped_dir=CROPPED_DIR, parallelism=STAGE_PARALLELISM,
+                 dry_run=False):
+    """
+    Exécute le graphe des étapes :
+    - par défaut : register, crop (alignement "crop" non fusionné, ou keep_cropped), ndvi, puis cube et
+      maps/timeseries selon cube/render ; download et extract seulement si demandés ;
+    - only : exactement ces étapes ; start : cette étape et ses descendantes activées ;
+    - scene_ids / sensors / date_from / date_to : scènes traitées par crop, ndvi, cog et maps.
+    Une ré-exécution partielle (only, start ou filtre de scènes) conserve la base et ses tables : seules les
+    scènes sélectionnées sont recalculées.
+    Retourne {étape: "ok" | "error" | "skipped" | "partial"} ; "partial" : étape terminée avec des échecs par scène
+    ou par archive (enregistrés dans pipeline_metrics).
+    """
+    enabled = {"register", "ndvi"}
+    enabled.update(name for name, wanted in (("download", download), ("extract", extract), ("cube", cube),
+                                             ("maps", render), ("timeseries", render)) if wanted)
+    if align == "crop" and (not fused or keep_cropped):
+        enabled.add("crop")
+    partial = bool(only or start or scene_ids or sensors or date_from or date_to)
+    replace = not incremental and not partial
 
-    # 1. S'assurer que le dossier 'src/bdd' existe
-    os.makedirs(DB_DIR, exist_ok=True)
-    logging.info(f"Dossier de la base de données : {DB_DIR}")
+    metrics = PipelineMetrics(jsonl_path=metrics_jsonl)
+    stages = build_stages(workers=workers, incremental=incremental, content_hash=content_hash, fused=fused,
+                          in_place=in_place, align=align, cog=cog, replace=replace, metrics=metrics, raw_dir=raw_dir,
+                          extract_dir=extract_dir, cropped_dir=cropped_dir,
+                          scene_filter=lambda con: select_scene_ids(con, scene_ids, sensors, date_from, date_to))
+    selected = select_stages(stages, enabled, only=only, start=start)
 
-    # 2. Supprimer l'ancienne base si elle existe AVANT connexion
-    if os.path.exists(DB_PATH):
-        logging.warning(f"Ancienne base détectée : suppression {DB_PATH}")
-        os.remove(DB_PATH)
+    if dry_run:
+        for name in selected:
+            stage = stages[name]
+            depends = [dep for dep in stage.depends if dep in selected]
+            print(f"{name:<11} après {', '.join(depends) or '-':<16} entrées : {', '.join(stage.inputs) or '-'}"
+                  f"  ->  sorties : {', '.join(stage.outputs) or '-'}")
+        return {}
 
-    # 3. Ouvrir une nouvelle connexion propre
-    con = duckdb.connect(DB_PATH)
-    logging.info(f"Connexion ouverte à la base : {DB_PATH}")
+    mode = "incrémental" if incremental else ("partiel" if partial else "complet")
+    logging.info(f"=== Pipeline NDVI : Démarrage ({workers} processus, mode {mode}, étapes {', '.join(selected)}) ===")
 
-    try:
-        # 4. Pipeline d'exécution
-        logging.info("Étape 1 : Création de la table downloads...")
-        create_downloads_table(con)
+    # 1. S'assurer que le dossier de la base existe
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    logging.info(f"Dossier de la base de données : {os.path.dirname(db_path)}")
 
-        logging.info("Étape 2 : Crop et enregistrement des images...")
-        crop_and_store_images(con)
+    # 2. Supprimer l'ancienne base si elle existe AVANT connexion (exécution complète uniquement)
+    if os.path.exists(db_path) and replace:
+        logging.warning(f"Ancienne base détectée : suppression {db_path}")
+        os.remove(db_path)
 
-        logging.info("Étape 3 : Calcul et standardisation du NDVI...")
-        standardize_and_compute_ndvi(con)
+    # 3. Ouvrir la connexion
+    con = duckdb.connect(db_path)
+    logging.info(f"Connexion ouverte à la base : {db_path}")
 
-    except Exception as e:
-        logging.exception(f"Erreur critique pendant l'exécution du pipeline : {e}")
+    try:
+        # 4. Étapes sélectionnées, les indépendantes en parallèle
+        status = run_stages(stages, selected, con, metrics=metrics, parallelism=parallelism)
 
     finally:
+        metrics.flush(con)
         con.close()
         logging.info("Connexion à la base fermée.")
+        metrics.log_summary()
+
+    failures = metrics.errors()
+    for failure in failures:
+        if status.get(failure.stage) == "ok":
+            status[failure.stage] = "partial"
+    skipped = [name for name, state in status.items() if state == "skipped"]
+    if failures or skipped:
+        logging.warning(f"=== Pipeline NDVI : Terminé avec {len(failures)} échec(s) et {len(skipped)} étape(s) ignorée(s) "
+                        f"(voir pipeline_metrics) ===")
+    else:
+        logging.info("=== Pipeline NDVI : Terminé avec succès ===")
+    return status
+
+
+def parse_args(argv=None):
+    """
+    Options en ligne de commande ; --config charge un fichier JSON dont les clés reprennent les noms des options
+    (ex. {"workers": 4, "align": "crop", "only": ["ndvi"]}), les options explicites restant prioritaires.
+    """
+    parser = argparse.ArgumentParser(description="Pipeline NDVI Landsat : download -> extract -> register -> crop -> ndvi")
+    parser.add_argument("--config", help="fichier de configuration JSON")
+    parser.add_argument("--only", type=lambda value: value.split(","), help="étapes à exécuter, séparées par des virgules")
+    parser.add_argument("--from", dest="start", help="étape de départ (puis ses descendantes activées)")
+    parser.add_argument("--dry-run", action="store_true", help="affiche les étapes sélectionnées sans les exécuter")
+    parser.add_argument("--scene", dest="scene_ids", action="append", help="identifiant de scène (répétable)")
+    parser.add_argument("--sensor", dest="sensors", action="append", help="préfixe capteur, ex. LC08 (répétable)")
+    parser.add_argument("--date-from", help="première date d'acquisition (AAAA-MM-JJ)")
+    parser.add_argument("--date-to", help="dernière date d'acquisition (AAAA-MM-JJ)")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--parallelism", type=int, default=STAGE_PARALLELISM, help="étapes indépendantes simultanées")
+    parser.add_argument("--incremental", action="store_true", default=INCREMENTAL)
+    parser.add_argument("--content-hash", action="store_true")
+    parser.add_argument("--align", choices=("aoi", "crop"), default=ALIGN)
+    parser.add_argument("--fused", action="store_true", default=FUSED)
+    parser.add_argument("--keep-cropped", action="store_true")
+    parser.add_argument("--in-place", action="store_true", help="lecture des bandes dans les archives, sans extraction")
+    parser.add_argument("--download", action="store_true", help="active la recherche et le téléchargement M2M")
+    parser.add_argument("--extract", action="store_true", help="active l'extraction des archives")
+    parser.add_argument("--cube", action="store_true", default=CUBE)
+    parser.add_argument("--cog", action="store_true", default=COG)
+    parser.add_argument("--render", action="store_true", default=RENDER)
+    parser.add_argument("--metrics-jsonl", default=METRICS_JSONL)
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--raw-dir", default=RAW_DIR)
+    parser.add_argument("--extract-dir", default=EXTRACT_DIR)
+    parser.add_argument("--cropped-dir", default=CROPPED_DIR)
+
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        with open(args.config) as f:
+            parser.set_defaults(**json.load(f))
+    args = vars(parser.parse_args(argv))
+    args.pop("config")
+    return args
 
-    logging.info("=== Pipeline NDVI : Terminé avec succès ===")
 
 # === Point d'entrée ===
 if __name__ == "__main__":
-    run_pipeline()
+    status = run_pipeline(**parse_args())
+    sys.exit(1 if {"error", "partial"} & set(status.values()) else 0)
@@ -0,0 +1,78 @@
+import math
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.transform import from_origin
+from rasterio.windows import Window, from_bounds
+
+# Zone d'étude, partagée avec la recherche M2M (telechargement_scenes.params) : [lon_min, lon_max, lat_min, lat_max]
+AOI_BOUNDING_BOX = (-9.5, -8.2, 8.5, 9.8)
+# Résolution de la grille commune, en mètres (celle des bandes réflectives Landsat)
+AOI_RESOLUTION = 30
+# Les coins de pixels Landsat Collection 2 tombent sur 15 m + k * 30 m : une grille calée dessus recopie les pixels sans interpolation
+AOI_GRID_OFFSET = 15
+BAND_RESAMPLING = Resampling.bilinear
+# La QA ne s'interpole pas : plus proche voisin, et 1 (bit "fill") hors de l'emprise de la scène
+QA_RESAMPLING = Resampling.nearest
+BAND_NODATA = 0
+QA_NODATA = 1
+
+AoiGrid = namedtuple("AoiGrid", ["crs", "transform", "width", "height"])
+
+
+def utm_crs(lon, lat):
+    zone = int((lon + 180) // 6) + 1
+    return f"EPSG:{(32600 if lat >= 0 else 32700) + zone}"
+
+
+@lru_cache(maxsize=None)
+def aoi_grid(bounding_box=AOI_BOUNDING_BOX, resolution=AOI_RESOLUTION, crs=None, offset=AOI_GRID_OFFSET):
+    """
+    Grille commune de la zone d'étude : UTM du centre de la zone (sauf crs explicite), pas de resolution mètres,
+    bords calés sur offset + k * resolution. Calculée une seule fois par processus.
+    """
+    lon_min, lon_max, lat_min, lat_max = bounding_box
+    crs = crs or utm_crs((lon_min + lon_max) / 2, (lat_min + lat_max) / 2)
+    left, bottom, right, top = transform_bounds("EPSG:4326", crs, lon_min, lat_min, lon_max, lat_max)
+    left = math.floor((left - offset) / resolution) * resolution + offset
+    top = math.ceil((top - offset) / resolution) * resolution + offset
+    width = math.ceil((right - left) / resolution)
+    height = math.ceil((top - bottom) / resolution)
+    return AoiGrid(crs, from_origin(left, top, resolution, resolution), width, height)
+
+
+@lru_cache(maxsize=None)
+def footprint_window(grid, src_crs, src_bounds):
+    """
+    Fenêtre de la grille couverte par l'emprise d'une scène (None si elle ne recoupe pas la zone).
+    Mise en cache par grille source : les dates d'un même path/row partagent le même calcul.
+    """
+    bounds = transform_bounds(src_crs, grid.crs, *src_bounds)
+    window = from_bounds(*bounds, transform=grid.transform)
+    col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+    window = Window(col_off, row_off, math.ceil(window.col_off + window.width) - col_off,
+                    math.ceil(window.row_off + window.height) - row_off)
+    try:
+        return window.intersection(Window(0, 0, grid.width, grid.height))
+    except rasterio.errors.WindowError:
+        return None
+
+
+@contextmanager
+def open_on_grid(path, grid=None, resampling=BAND_RESAMPLING, nodata=BAND_NODATA):
+    """
+    Ouvre une bande telle quelle (grid=None) ou reprojetée à la volée sur la grille commune via un WarpedVRT.
+    La transformation cible est fournie explicitement : GDAL n'a pas à recalculer la grille de sortie.
+    """
+    with rasterio.open(path) as src:
+        if grid is None:
+            yield src
+            return
+        with WarpedVRT(src, crs=grid.crs, transform=grid.transform, width=grid.width, height=grid.height,
+                       resampling=resampling, src_nodata=nodata, nodata=nodata) as vrt:
+            yield vrt
@@ -1,40 +1,225 @@
 import os
+import re
 import duckdb
-from pathlib import Path
 import rasterio
+import tarfile
+import pyarrow as pa
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from utils.extraction_images import EXTRACT_DIR, RAW_DIR, member_wanted
+from utils.incremental import fingerprint_files, mark_completed, select_changed
+from utils.sensors import band_scaling, logical_band, parse_mtl_scaling
+
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE_DIR, "bdd", "ndvi.duckdb")
 
+# Bandes enregistrées ; None = rouge/PIR/QA_PIXEL selon le capteur de chaque scène (utils.sensors)
+BANDS = None
+HEADER_THREADS = 8
+
+# Identifiant produit Landsat Collection 2 : LXSS_LLLL_PPPRRR_YYYYMMDD_yyyymmdd_CC_TX_<bande>.TIF
+PRODUCT_ID_RE = re.compile(
+    r"^(?P<scene_id>(?P<sensor>L[CTEOM]\d{2})_(?P<level>\w{4})_(?P<wrs_path>\d{3})(?P<wrs_row>\d{3})"
+    r"_(?P<acquired>\d{8})_\d{8}_\d{2}_\w{2})_(?P<band>\w+?)\.TIF$",
+    re.IGNORECASE
+)
+MTL_DIMENSION_RE = re.compile(r"^\s*REFLECTIVE_(LINES|SAMPLES)\s*=\s*(\d+)", re.MULTILINE)
+
+
+def parse_product_id(filename):
+    """
+    Extrait scene_id, capteur, path/row WRS-2, date d'acquisition et bande du nom de fichier, sans l'ouvrir.
+    """
+    match = PRODUCT_ID_RE.match(filename)
+    if match is None:
+        scene_id, _, band = filename.rsplit(".", 1)[0].rpartition("_")
+        return {"scene_id": scene_id, "sensor": None, "level": None, "wrs_path": None, "wrs_row": None,
+                "acquisition_date": None, "band": band}
+    return {
+        "scene_id": match["scene_id"],
+        "sensor": match["sensor"].upper(),
+        "level": match["level"].upper(),
+        "wrs_path": int(match["wrs_path"]),
+        "wrs_row": int(match["wrs_row"]),
+        "acquisition_date": datetime.strptime(match["acquired"], "%Y%m%d").date(),
+        "band": match["band"].upper(),
+    }
+
+
+def parse_mtl_dimensions(text):
+    """
+    Dimensions des bandes réflectives lues dans le contenu d'un fichier MTL (None si absentes).
+    """
+    values = dict(MTL_DIMENSION_RE.findall(text))
+    if "SAMPLES" in values and "LINES" in values:
+        return int(values["SAMPLES"]), int(values["LINES"])
+    return None
+
+
+def parse_mtl(text):
+    """
+    Métadonnées utiles d'un MTL : dimensions des bandes réflectives et facteurs de réflectance par bande.
+    """
+    return {"dimensions": parse_mtl_dimensions(text), "scaling": parse_mtl_scaling(text)}
+
+
+def read_mtl(mtl_path):
+    try:
+        with open(mtl_path) as f:
+            return parse_mtl(f.read())
+    except OSError:
+        return {"dimensions": None, "scaling": {}}
+
 
-def create_downloads_table(con):
-    extract_path = os.path.join(BASE_DIR, "data", "raw", "extract")
+def read_dimensions(path):
+    with rasterio.open(path) as src:
+        return src.width, src.height
 
-    con.execute("""
-        CREATE OR REPLACE TABLE downloads (
+
+def scan_extract_tree(extract_path, bands=BANDS):
+    """
+    Parcours unique de l'arborescence : retourne les bandes recherchées et les métadonnées MTL par scène.
+    """
+    images, metadata = [], {}
+    for dirpath, _, filenames in os.walk(extract_path):
+        for filename in filenames:
+            upper = filename.upper()
+            if upper.endswith("_MTL.TXT"):
+                metadata[filename[:-len("_MTL.txt")]] = read_mtl(os.path.join(dirpath, filename))
+            elif upper.endswith(".TIF") and member_wanted(filename, bands):
+                images.append(os.path.abspath(os.path.join(dirpath, filename)))
+    return images, metadata
+
+
+def scan_archives(raw_path, bands=BANDS):
+    """
+    Variante sans extraction : bandes lues en place dans les .tar via /vsitar/, MTL lu directement dans l'archive.
+    """
+    images, metadata = [], {}
+    for tar_path in sorted(Path(raw_path).glob("*.tar")):
+        with tarfile.open(tar_path, "r:") as tar:
+            for member in tar.getmembers():
+                filename = os.path.basename(member.name)
+                if not member.isfile():
+                    continue
+                if member_wanted(filename, bands) and filename.upper().endswith(".TIF"):
+                    images.append(f"/vsitar/{tar_path.resolve()}/{os.path.normpath(member.name)}")
+                elif filename.upper().endswith("_MTL.TXT"):
+                    with tar.extractfile(member) as f:
+                        metadata[filename[:-len("_MTL.txt")]] = parse_mtl(f.read().decode(errors="ignore"))
+    return images, metadata
+
+
+def create_downloads_table(con, incremental=False, content_hash=False, threads=HEADER_THREADS, in_place=False,
+                           extract_path=EXTRACT_DIR, raw_path=RAW_DIR, replace=None):
+
+    # En mode incrémental, la table est conservée et seuls les fichiers nouveaux ou modifiés sont relus.
+    # replace=False : table conservée mais tous les fichiers relus (ré-exécution sélective)
+    replace = not incremental if replace is None else replace
+    create_mode = "CREATE OR REPLACE TABLE" if replace else "CREATE TABLE IF NOT EXISTS"
+    con.execute(f"""
+        {create_mode} downloads (
             filename TEXT,
             band TEXT,
             date_downloaded TIMESTAMP,
             image_path TEXT,
             width INT,
             height INT,
+            scene_id TEXT,
+            sensor TEXT,
+            wrs_path INT,
+            wrs_row INT,
+            acquisition_date DATE,
+            logical_band TEXT,
+            scale_factor DOUBLE,
+            add_offset DOUBLE,
             PRIMARY KEY(filename, band)
         );
     """)
 
-    extract_path_obj = Path(extract_path)
-    paths_to_images = list(extract_path_obj.rglob("*_B3.TIF")) + list(extract_path_obj.rglob("*_B4.TIF"))
+    if in_place:
+        paths_to_images, metadata = scan_archives(raw_path)
+    else:
+        paths_to_images, metadata = scan_extract_tree(extract_path)
+
+    fingerprints = {path: fingerprint_files([path], content_hash) for path in paths_to_images}
+    if incremental:
+        changed = set(select_changed(con, "register", fingerprints))
+        paths_to_images = [path for path in paths_to_images if path in changed]
+    if not paths_to_images:
+        return
+
+    rows = [dict(parse_product_id(os.path.basename(path)), filename=os.path.basename(path), image_path=path)
+            for path in paths_to_images]
+
+    # Dimensions : d'abord le MTL de la scène, sinon lecture des en-têtes GeoTIFF en parallèle
+    mtl_dims = {scene_id: mtl["dimensions"] for scene_id, mtl in metadata.items()}
+    to_open = [row["image_path"] for row in rows if mtl_dims.get(row["scene_id"]) is None]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        opened = dict(zip(to_open, executor.map(read_dimensions, to_open)))
+    for row in rows:
+        row["width"], row["height"] = opened.get(row["image_path"]) or mtl_dims[row["scene_id"]]
+
+    # Rôle de la bande pour le capteur de la scène, et conversion DN -> réflectance (la QA n'est pas mise à l'échelle)
+    for row in rows:
+        row["logical_band"] = logical_band(row["scene_id"], row["band"])
+        scaling = None if row["logical_band"] in (None, "qa") else band_scaling(
+            row["level"], row["band"], metadata.get(row["scene_id"], {}).get("scaling"), row["sensor"])
+        row["scale_factor"], row["add_offset"] = scaling or (None, None)
+
+    now = datetime.now()
+    batch = pa.table({
+        "filename": pa.array([row["filename"] for row in rows], pa.string()),
+        "band": pa.array([row["band"] for row in rows], pa.string()),
+        "date_downloaded": pa.array([now] * len(rows), pa.timestamp("us")),
+        "image_path": pa.array([row["image_path"] for row in rows], pa.string()),
+        "width": pa.array([row["width"] for row in rows], pa.int32()),
+        "height": pa.array([row["height"] for row in rows], pa.int32()),
+        "scene_id": pa.array([row["scene_id"] for row in rows], pa.string()),
+        "sensor": pa.array([row["sensor"] for row in rows], pa.string()),
+        "wrs_path": pa.array([row["wrs_path"] for row in rows], pa.int32()),
+        "wrs_row": pa.array([row["wrs_row"] for row in rows], pa.int32()),
+        "acquisition_date": pa.array([row["acquisition_date"] for row in rows], pa.date32()),
+        "logical_band": pa.array([row["logical_band"] for row in rows], pa.string()),
+        "scale_factor": pa.array([row["scale_factor"] for row in rows], pa.float64()),
+        "add_offset": pa.array([row["add_offset"] for row in rows], pa.float64()),
+    })
+
+    # Une seule instruction pour tout le catalogue au lieu d'un INSERT par fichier
+    con.register("downloads_batch", batch)
+    try:
+        con.execute("INSERT OR REPLACE INTO downloads SELECT * FROM downloads_batch")
+    finally:
+        con.unregister("downloads_batch")
+
+    mark_completed(con, "register", {path: fingerprints[path] for path in paths_to_images})
 
-    for path in paths_to_images:
-        with rasterio.open(path) as src:
-            width, height = src.width, src.height
 
-        filename = path.name
-        band = 'B3' if '_B3' in filename else 'B4'
-        con.execute("""
-            INSERT OR IGNORE INTO downloads VALUES (?, ?, ?, ?, ?, ?)
-        """, (filename, band, datetime.now(), str(path.resolve()), width, height))
+def select_scene_ids(con, scene_ids=None, sensors=None, date_from=None, date_to=None):
+    """
+    Scènes de downloads retenues par les filtres (identifiants, préfixes capteur LC08/LE07..., période d'acquisition).
+    Retourne None sans filtre, pour que les étapes traitent toutes les scènes.
+    """
+    if not (scene_ids or sensors or date_from or date_to):
+        return None
+    conditions, params = [], []
+    if scene_ids:
+        conditions.append(f"scene_id IN ({', '.join('?' * len(scene_ids))})")
+        params.extend(scene_ids)
+    if sensors:
+        conditions.append(f"upper(sensor) IN ({', '.join('?' * len(sensors))})")
+        params.extend(sensor.upper() for sensor in sensors)
+    if date_from:
+        conditions.append("acquisition_date >= CAST(? AS DATE)")
+        params.append(date_from)
+    if date_to:
+        conditions.append("acquisition_date <= CAST(? AS DATE)")
+        params.append(date_to)
+    rows = con.execute(f"SELECT DISTINCT scene_id FROM downloads WHERE {' AND '.join(conditions)} ORDER BY scene_id",
+                       params).fetchall()
+    return [scene_id for (scene_id,) in rows]
 
 
 if __name__ == "__main__":
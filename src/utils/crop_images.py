@@ -1,76 +1,163 @@
 import os
+import logging
 import duckdb
 import numpy as np
 import rasterio
+from rasterio.windows import Window
+
+from utils.metrics import count_pixels
+from utils.incremental import fingerprint_files, mark_completed, select_changed
+from utils.parallel import batched, map_scenes
+from utils.qa_mask import QA_MASK_BITS, pack_mask, qa_valid_mask
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE_DIR, "bdd", "ndvi.duckdb")
 CROPPED_DIR = os.path.join(BASE_DIR, "data", "cropped")
+BATCH_SIZE = 64
 
-def crop_center(img: np.ndarray, crop_ratio: float = 0.5) -> np.ndarray:
-    h, w = img.shape
-    crop_size = int(min(h, w) * crop_ratio)
-    center_h, center_w = h // 2, w // 2
+def center_window(height: int, width: int, crop_ratio: float = 0.5) -> Window:
+    """
+    Fenêtre carrée centrale couvrant crop_ratio du plus petit côté, calculée sans lire de pixels.
+    """
+    crop_size = int(min(height, width) * crop_ratio)
+    center_h, center_w = height // 2, width // 2
     half_crop = crop_size // 2
-    return img[center_h - half_crop:center_h + half_crop, center_w - half_crop:center_w + half_crop]
+    return Window(center_w - half_crop, center_h - half_crop, 2 * half_crop, 2 * half_crop)
+
+def crop_center(img: np.ndarray, crop_ratio: float = 0.5) -> np.ndarray:
+    return img[center_window(*img.shape, crop_ratio=crop_ratio).toslices()]
+
+def crop_band(path, output_path, crop_ratio=0.5):
+    """
+    Lit uniquement la fenêtre centrale de la bande et l'écrit en conservant le CRS et la géotransformation décalée.
+    """
+    with rasterio.open(path) as src:
+        window = center_window(src.height, src.width, crop_ratio)
+        array = src.read(1, window=window)
+        profile = src.profile
+        profile.update(
+            driver='GTiff',
+            height=array.shape[0],
+            width=array.shape[1],
+            count=1,
+            transform=src.window_transform(window)
+        )
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        dst.write(array, 1)
+
+    return array.shape
+
+def crop_mask(qa_path, output_path, crop_ratio=0.5):
+    """
+    Lit la fenêtre centrale de QA_PIXEL, la décode et enregistre le masque de validité compacté (1 bit par pixel) en .npy.
+    """
+    with rasterio.open(qa_path) as src:
+        qa = src.read(1, window=center_window(src.height, src.width, crop_ratio))
+    np.save(output_path, pack_mask(qa_valid_mask(qa)))
+    return qa.shape
+
+def crop_scene(scene_id, red_path, nir_path, qa_path=None, crop_ratio=0.5, output_dir=CROPPED_DIR):
+    """
+    Crop d'une scène : lit la fenêtre centrale des bandes rouge/PIR (et de QA_PIXEL si présente), écrit les GeoTIFF croppés
+    et le masque compacté, et retourne la ligne cropped_images.
+    Exécutable dans un processus fils (aucun accès à la base).
+    """
+    output_red = os.path.join(output_dir, f"{scene_id}_RED_crop.tif")
+    output_nir = os.path.join(output_dir, f"{scene_id}_NIR_crop.tif")
+    output_mask = os.path.join(output_dir, f"{scene_id}_MASK_crop.npy") if qa_path else None
+
+    height, width = crop_band(red_path, output_red, crop_ratio)
+    crop_band(nir_path, output_nir, crop_ratio)
+    if qa_path:
+        crop_mask(qa_path, output_mask, crop_ratio)
+    count_pixels(height * width)
 
-def crop_and_store_images(con):
+    return scene_id, output_red, output_nir, output_mask, width, height
+
+def select_band_pairs(con):
+    """
+    (scene_id, chemin rouge, chemin PIR, chemin QA_PIXEL ou None) pour chaque scène enregistrée dans downloads.
+    Les fichiers sont choisis par bande logique : B3/B4 pour TM/ETM+, B4/B5 pour OLI (utils.sensors).
+    """
+    return con.execute("""
+        SELECT red.scene_id, red.image_path, nir.image_path, qa.image_path
+        FROM downloads red
+        JOIN downloads nir ON nir.scene_id = red.scene_id AND nir.logical_band = 'nir'
+        LEFT JOIN downloads qa ON qa.scene_id = red.scene_id AND qa.logical_band = 'qa'
+        WHERE red.logical_band = 'red'
+        ORDER BY red.scene_id
+    """).fetchall()
+
+def select_band_scalings(con):
+    """
+    {scene_id: ((scale, offset) rouge, (scale, offset) PIR)} pour convertir les comptes numériques en réflectance.
+    Les scènes sans mise à l'échelle connue (niveau 1 TM/ETM+ sans facteurs MTL) sont absentes : NDVI en comptes bruts.
+    """
+    rows = con.execute("""
+        SELECT red.scene_id, red.scale_factor, red.add_offset, nir.scale_factor, nir.add_offset
+        FROM downloads red
+        JOIN downloads nir ON nir.scene_id = red.scene_id AND nir.logical_band = 'nir'
+        WHERE red.logical_band = 'red' AND red.scale_factor IS NOT NULL AND nir.scale_factor IS NOT NULL
+    """).fetchall()
+    return {scene_id: ((red_scale, red_offset), (nir_scale, nir_offset))
+            for scene_id, red_scale, red_offset, nir_scale, nir_offset in rows}
+
+def scene_fingerprints(scenes, params=None, content_hash=False):
+    """
+    params : paramètres communs de l'étape, ou fonction scene_id -> paramètres (ex. mise à l'échelle propre à la scène).
+    content_hash : empreinte du contenu des fichiers en plus de leur taille et mtime (voir fingerprint_files).
+    """
+    params_for = params if callable(params) else (lambda scene_id: params)
+    return {scene_id: fingerprint_files([path for path in paths if path], content_hash=content_hash,
+                                        params=params_for(scene_id))
+            for scene_id, *paths in scenes}
+
+def crop_and_store_images(con, workers=1, batch_size=BATCH_SIZE, incremental=False, metrics=None, output_dir=CROPPED_DIR,
+                          scene_ids=None, replace=None, crop_ratio=0.5, content_hash=False):
     print("Cropping des images...")
 
-    os.makedirs(CROPPED_DIR, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
 
-    con.execute("""
-        CREATE OR REPLACE TABLE cropped_images (
+    replace = not incremental if replace is None else replace
+    create_mode = "CREATE OR REPLACE TABLE" if replace else "CREATE TABLE IF NOT EXISTS"
+    con.execute(f"""
+        {create_mode} cropped_images (
             scene_id TEXT PRIMARY KEY,
-            b3_crop_path TEXT,
-            b4_crop_path TEXT,
+            red_crop_path TEXT,
+            nir_crop_path TEXT,
+            mask_path TEXT,
             width INT,
             height INT
         );
     """)
 
-    scenes = con.execute("""
-        SELECT DISTINCT split_part(filename, '_B3.TIF', 1) AS scene_id
-        FROM downloads
-        WHERE band = 'B3'
-    """).fetchall()
+    scenes = select_band_pairs(con)
+    if scene_ids is not None:
+        wanted = set(scene_ids)
+        scenes = [scene for scene in scenes if scene[0] in wanted]
 
-    for (scene_id,) in scenes:
-        try:
-            b3_path, = con.execute("SELECT image_path FROM downloads WHERE filename LIKE ?", (scene_id + '_B3.TIF',)).fetchone()
-            b4_path, = con.execute("SELECT image_path FROM downloads WHERE filename LIKE ?", (scene_id + '_B4.TIF',)).fetchone()
-
-            with rasterio.open(b3_path) as src:
-                b3 = src.read(1)
-            with rasterio.open(b4_path) as src:
-                b4 = src.read(1)
-
-            b3_crop = crop_center(b3)
-            b4_crop = crop_center(b4)
-
-            output_b3 = os.path.join(CROPPED_DIR, f"{scene_id}_B3_crop.tif")
-            output_b4 = os.path.join(CROPPED_DIR, f"{scene_id}_B4_crop.tif")
-
-            for array, path in zip([b3_crop, b4_crop], [output_b3, output_b4]):
-                with rasterio.open(
-                    path,
-                    'w',
-                    driver='GTiff',
-                    height=array.shape[0],
-                    width=array.shape[1],
-                    count=1,
-                    dtype=array.dtype,
-                    crs='+proj=latlong',
-                    transform=rasterio.Affine.identity()
-                ) as dst:
-                    dst.write(array, 1)
-
-            con.execute("""
-                INSERT OR REPLACE INTO cropped_images VALUES (?, ?, ?, ?, ?)
-            """, (scene_id, output_b3, output_b4, b3_crop.shape[1], b3_crop.shape[0]))
+    fingerprints = scene_fingerprints(scenes, {"crop_ratio": crop_ratio, "qa_mask_bits": QA_MASK_BITS},
+                                      content_hash=content_hash)
+    if incremental:
+        changed = set(select_changed(con, "crop", fingerprints))
+        scenes = [scene for scene in scenes if scene[0] in changed]
+        print(f"{len(scenes)} scène(s) nouvelle(s) ou modifiée(s) à cropper.")
 
+    tasks = [(*scene, crop_ratio, output_dir) for scene in scenes]
+    results = map_scenes(crop_scene, tasks, workers=workers, error_msg="Erreur de crop pour", metrics=metrics)
+    for batch in batched(results, batch_size):
+        # Un lot en échec est consigné sans interrompre l'étape : ses scènes seront recroppées à la prochaine exécution
+        try:
+            con.executemany("""
+                INSERT OR REPLACE INTO cropped_images VALUES (?, ?, ?, ?, ?, ?)
+            """, batch)
+            mark_completed(con, "crop", {row[0]: fingerprints[row[0]] for row in batch})
         except Exception as e:
-            print(f"Erreur de crop pour {scene_id} : {e}")
+            logging.error(f"Erreur d'écriture du crop pour {[row[0] for row in batch]} : {e}")
+            if metrics is not None:
+                for row in batch:
+                    metrics.record_error(row[0], e)
 
     print("Cropping terminé.")
 
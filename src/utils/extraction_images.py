@@ -1,29 +1,73 @@
 import os
 import shutil
+import tarfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Import relatif : ce module est aussi importé en tant que src.utils.extraction_images (telechargement_scenes).
+# À lancer comme module (python -m utils.extraction_images depuis src/), pas comme script.
+from .sensors import sensor_bands
 
 # Base directory = /src
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 RAW_DIR = os.path.join(BASE_DIR, "data", "raw", "landsat")
 EXTRACT_DIR = os.path.join(BASE_DIR, "data", "raw", "extract")
 
-def extract_images():
+# Bandes écrites sur disque (en plus du MTL) ; None = bandes rouge/PIR/QA du capteur de chaque scène (utils.sensors)
+EXTRACT_BANDS = None
+EXTRACT_WORKERS = 4
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+def member_wanted(name, bands=EXTRACT_BANDS):
+    upper = os.path.basename(name).upper()
+    if bands is None:
+        bands = sensor_bands(upper)
+    return upper.endswith("_MTL.TXT") or any(upper.endswith(f"_{band}.TIF") for band in bands)
+
+def extract_archive(tar_path, extract_dir=EXTRACT_DIR, bands=EXTRACT_BANDS):
+    """
+    Lit l'archive en flux et n'écrit que les membres utiles ; les fichiers déjà présents avec la bonne taille sont ignorés.
+    """
+    written = []
+    with tarfile.open(tar_path, "r|*") as tar:
+        for member in tar:
+            if not member.isfile() or not member_wanted(member.name, bands):
+                continue
+            # basename : les archives Landsat sont plates, et cela évite toute sortie du dossier cible
+            target = os.path.join(extract_dir, os.path.basename(member.name))
+            if os.path.exists(target) and os.path.getsize(target) == member.size:
+                continue
+            part = target + ".part"
+            with tar.extractfile(member) as src, open(part, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+            os.replace(part, target)
+            written.append(target)
+    return written
+
+def extract_images(bands=EXTRACT_BANDS, workers=EXTRACT_WORKERS, raw_dir=RAW_DIR, extract_dir=EXTRACT_DIR):
     """
-    Décompresse les archives .tar dans le dossier 'extract'.
+    Décompresse les archives .tar dans le dossier 'extract' (uniquement les bandes demandées et le MTL).
+    Retourne {nom d'archive: erreur} pour les archives en échec.
     """
     print("Extraction des images Landsat...")
 
-    os.makedirs(EXTRACT_DIR, exist_ok=True)
-    raw_path = Path(RAW_DIR)
+    os.makedirs(extract_dir, exist_ok=True)
+    raw_path = Path(raw_dir)
+    archives = sorted(raw_path.glob("*.tar"))
+    failures = {}
 
-    for file_path in raw_path.glob("*.tar"):
-        try:
-            shutil.unpack_archive(str(file_path), EXTRACT_DIR)
-            print(f"{file_path.name} extrait.")
-        except Exception as e:
-            print(f"Erreur lors de l'extraction de {file_path.name} : {e}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(extract_archive, str(file_path), extract_dir, bands): file_path for file_path in archives}
+        for future, file_path in futures.items():
+            try:
+                written = future.result()
+                print(f"{file_path.name} extrait ({len(written)} fichier(s) écrit(s)).")
+            except Exception as e:
+                print(f"Erreur lors de l'extraction de {file_path.name} : {e}")
+                failures[file_path.name] = e
 
     print("Extraction terminée.")
+    return failures
 
 if __name__ == "__main__":
     extract_images()
@@ -0,0 +1,66 @@
+import os
+import hashlib
+from datetime import datetime
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def create_state_table(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_state (
+            stage TEXT,
+            item_id TEXT,
+            fingerprint TEXT,
+            completed_at TIMESTAMP,
+            PRIMARY KEY(stage, item_id)
+        );
+    """)
+
+
+def physical_path(path):
+    """
+    Fichier réellement présent sur disque : pour un chemin GDAL /vsitar/, l'archive .tar qui le contient.
+    """
+    if path.startswith("/vsitar/"):
+        archive, sep, _ = path[len("/vsitar"):].partition(".tar/")
+        return archive + ".tar" if sep else archive
+    return path
+
+
+def fingerprint_files(paths, content_hash=False, params=None):
+    """
+    Empreinte d'un ensemble de fichiers : chemin, taille et mtime, plus le contenu si content_hash=True.
+    params : paramètres de l'étape ({nom: valeur}) ; les changer invalide le résultat comme un fichier modifié.
+    """
+    digest = hashlib.sha1()
+    if params:
+        digest.update(repr(sorted(params.items())).encode())
+    for path in map(str, paths):
+        stat = os.stat(physical_path(path))
+        digest.update(f"{path if path.startswith('/vsi') else os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+        if content_hash:
+            with open(physical_path(path), "rb") as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def select_changed(con, stage, fingerprints):
+    """
+    Retourne les éléments dont l'empreinte diffère de celle enregistrée à la dernière exécution de l'étape.
+    """
+    create_state_table(con)
+    known = dict(con.execute(
+        "SELECT item_id, fingerprint FROM pipeline_state WHERE stage = ?", (stage,)
+    ).fetchall())
+    return [item_id for item_id, fingerprint in fingerprints.items() if known.get(item_id) != fingerprint]
+
+
+def mark_completed(con, stage, fingerprints):
+    if not fingerprints:
+        return
+    create_state_table(con)
+    now = datetime.now()
+    con.executemany("""
+        INSERT OR REPLACE INTO pipeline_state VALUES (?, ?, ?, ?)
+    """, [(stage, item_id, fingerprint, now) for item_id, fingerprint in fingerprints.items()])
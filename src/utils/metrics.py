@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+import duckdb
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+DB_PATH = os.path.join(BASE_DIR, "bdd", "ndvi.duckdb")
+# Nombre d'étapes et de scènes les plus lentes listées dans le résumé de fin d'exécution
+SUMMARY_TOP = 5
+
+# Mesure d'une étape (scene_id None) ou d'une scène :
+# - wall_s / cpu_s : temps écoulé et temps CPU (utilisateur + système, processus fils inclus pour une étape) ;
+# - peak_rss_mb : pic de mémoire résidente du processus pendant la mesure (le plus gros processus pour une étape) ;
+# - bytes_read / bytes_written : octets lus/écrits par appels système (fichiers, cache compris, et tubes inter-processus) ;
+# - pixels : pixels traités, déclarés par le code de calcul via count_pixels.
+Sample = namedtuple("Sample", ["stage", "scene_id", "started_at", "wall_s", "cpu_s", "peak_rss_mb", "bytes_read",
+                               "bytes_written", "pixels", "status", "error", "pid"])
+
+# Mesures en cours dans chaque thread, de la plus externe à la plus interne. Des étapes lancées en parallèle
+# (threads) ont chacune leur pile, mais partagent les compteurs du processus (CPU, E/S, pic mémoire).
+_local = threading.local()
+# Nombre de mesures en cours dans chaque thread du processus : le pic mémoire (VmHWM) est commun à tout le processus,
+# il n'est remis à zéro que si aucune mesure d'un autre thread n'est en cours
+_running = {}
+_running_lock = threading.Lock()
+
+
+def _active():
+    if not hasattr(_local, "probes"):
+        _local.probes = []
+    return _local.probes
+
+
+def _cpu_seconds(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _io_bytes():
+    """
+    (rchar, wchar) du processus d'après /proc/self/io ; (0, 0) hors Linux.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _peak_rss_mb():
+    """
+    Pic de mémoire résidente (VmHWM) depuis la dernière remise à zéro ; à défaut, pic depuis le démarrage du processus.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss est en kilo-octets sous Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    # Linux : écrire 5 dans clear_refs remet VmHWM à la mémoire résidente courante
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class _Probe:
+    """
+    Mesure en cours : deltas de temps, CPU et E/S, et pic mémoire propre à la mesure.
+    Les mesures s'imbriquent (étape puis scène en mode séquentiel) : avant chaque remise à zéro du pic,
+    la valeur courante est reportée sur les mesures englobantes.
+    Pendant qu'une mesure d'un autre thread est en cours (étapes parallèles), le pic n'est pas remis à zéro :
+    celui de la nouvelle mesure part alors du pic courant du processus et peut être surestimé, jamais sous-estimé.
+    """
+
+    def __init__(self, children=False):
+        self.children = children
+        self.pixels = 0
+        self.peak = 0.0
+
+    def start(self):
+        thread = threading.get_ident()
+        with _running_lock:
+            peak = _peak_rss_mb()
+            for probe in _active():
+                probe.peak = max(probe.peak, peak)
+            if not any(count for other, count in _running.items() if other != thread):
+                _reset_peak_rss()
+            _running[thread] = _running.get(thread, 0) + 1
+        _active().append(self)
+        self.started_at = datetime.now()
+        self.wall = time.perf_counter()
+        self.cpu = _cpu_seconds() + (_cpu_seconds(resource.RUSAGE_CHILDREN) if self.children else 0)
+        self.io = _io_bytes()
+        return self
+
+    def stop(self, stage=None, scene_id=None, error=None):
+        wall = time.perf_counter() - self.wall
+        cpu = _cpu_seconds() + (_cpu_seconds(resource.RUSAGE_CHILDREN) if self.children else 0) - self.cpu
+        read, written = _io_bytes()
+        peak = _peak_rss_mb()
+        active = _active()
+        active.remove(self)
+        thread = threading.get_ident()
+        with _running_lock:
+            _running[thread] -= 1
+            if not _running[thread]:
+                del _running[thread]
+        for probe in active + [self]:
+            probe.peak = max(probe.peak, peak)
+        if active:
+            # Comme les deltas de temps et d'E/S, les pixels d'une mesure comptent pour la mesure englobante
+            active[-1].pixels += self.pixels
+        return Sample(stage, scene_id, self.started_at, round(wall, 4), round(cpu, 4), round(self.peak, 1),
+                      read - self.io[0], written - self.io[1], self.pixels, "error" if error else "ok",
+                      str(error) if error else None, os.getpid())
+
+
+def count_pixels(n):
+    """
+    Déclare n pixels traités pour la mesure la plus interne de ce thread (sans effet hors mesure).
+    """
+    active = _active()
+    if active:
+        active[-1].pixels += int(n)
+
+
+def measured_call(scene_id, func, task):
+    """
+    Exécute func(*task) sous mesure, dans le processus qui fait le calcul (fils ou principal).
+    Retourne (résultat, Sample) ; une exception est convertie en Sample d'erreur au lieu d'être propagée.
+    """
+    probe = _Probe().start()
+    try:
+        result = func(*task)
+    except Exception as e:
+        return None, probe.stop(scene_id=scene_id, error=e)
+    return result, probe.stop(scene_id=scene_id)
+
+
+def create_metrics_table(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_metrics (
+            run_id TEXT,
+            stage TEXT,
+            scene_id TEXT,
+            started_at TIMESTAMP,
+            wall_s DOUBLE,
+            cpu_s DOUBLE,
+            peak_rss_mb DOUBLE,
+            bytes_read BIGINT,
+            bytes_written BIGINT,
+            pixels BIGINT,
+            status TEXT,
+            error TEXT,
+            pid INTEGER
+        );
+    """)
+
+
+class PipelineMetrics:
+    """
+    Collecte des mesures d'une exécution du pipeline : une ligne par étape et une par scène.
+    Les lignes sont écrites au fil de l'eau dans jsonl_path (si fourni), puis dans pipeline_metrics par flush(con).
+    """
+
+    def __init__(self, run_id=None, jsonl_path=None):
+        self.run_id = run_id or datetime.now().strftime("%Y%m%dT%H%M%S")
+        self.jsonl_path = jsonl_path
+        self.samples = []
+        self._flushed = 0
+        self._lock = threading.Lock()
+        # Étape en cours et scènes mesurées, propres au thread qui exécute l'étape
+        self._local = threading.local()
+
+    @property
+    def current_stage(self):
+        return getattr(self._local, "stage", None)
+
+    @property
+    def _stage_scenes(self):
+        return getattr(self._local, "scenes", [])
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Mesure une étape ; les scènes traitées dans des processus fils y sont agrégées (E/S, pixels, pic mémoire).
+        Une exception est enregistrée (status "error") puis propagée.
+        """
+        previous, previous_scenes = self.current_stage, self._stage_scenes
+        self._local.stage, self._local.scenes = name, []
+        probe = _Probe(children=True).start()
+        error = None
+        try:
+            yield self
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            sample = probe.stop(stage=name, error=error)
+            # Les scènes mesurées dans ce processus sont déjà comptées dans les deltas de l'étape
+            remote = [s for s in self._stage_scenes if s.pid != sample.pid]
+            sample = sample._replace(
+                peak_rss_mb=max([sample.peak_rss_mb] + [s.peak_rss_mb for s in remote]),
+                bytes_read=sample.bytes_read + sum(s.bytes_read for s in remote),
+                bytes_written=sample.bytes_written + sum(s.bytes_written for s in remote),
+                pixels=sample.pixels + sum(s.pixels for s in remote),
+            )
+            self.record(sample)
+            # Étapes imbriquées : les scènes de l'étape interne comptent aussi pour l'étape englobante
+            self._local.stage, self._local.scenes = previous, previous_scenes + self._stage_scenes
+
+    def record(self, sample):
+        with self._lock:
+            self.samples.append(sample)
+            if self.jsonl_path:
+                os.makedirs(os.path.dirname(os.path.abspath(self.jsonl_path)), exist_ok=True)
+                with open(self.jsonl_path, "a") as f:
+                    f.write(json.dumps({"run_id": self.run_id, **sample._asdict()}, default=str) + "\n")
+
+    def record_scene(self, sample):
+        sample = sample._replace(stage=self.current_stage)
+        self._stage_scenes.append(sample)
+        self.record(sample)
+
+    def record_error(self, scene_id, error):
+        """
+        Échec hors calcul mesuré (ex. écriture en base d'un lot) : ligne d'erreur sans mesure.
+        """
+        self.record(Sample(self.current_stage, scene_id, datetime.now(), 0.0, 0.0, 0.0, 0, 0, 0, "error", str(error),
+                           os.getpid()))
+
+    def errors(self):
+        return [s for s in self.samples if s.status == "error"]
+
+    def flush(self, con):
+        """
+        Ajoute à pipeline_metrics les lignes pas encore enregistrées.
+        """
+        create_metrics_table(con)
+        rows = [(self.run_id, *sample) for sample in self.samples[self._flushed:]]
+        if rows:
+            con.executemany(f"INSERT INTO pipeline_metrics VALUES ({', '.join('?' * 13)})", rows)
+        self._flushed = len(self.samples)
+
+    def log_summary(self, top=SUMMARY_TOP):
+        """
+        Résumé de fin d'exécution : étapes et scènes les plus lentes, débit en pixels et erreurs.
+        """
+        stages = [s for s in self.samples if s.scene_id is None]
+        scenes = [s for s in self.samples if s.scene_id is not None and s.status == "ok"]
+        logging.info(f"=== Mesures de l'exécution {self.run_id} ===")
+        for s in sorted(stages, key=lambda s: s.wall_s, reverse=True)[:top]:
+            rate = f", {s.pixels / s.wall_s / 1e6:.1f} Mpx/s" if s.pixels and s.wall_s else ""
+            logging.info(f"Étape {s.stage} : {s.wall_s:.2f} s (CPU {s.cpu_s:.2f} s), pic {s.peak_rss_mb:.0f} Mo, "
+                         f"{s.bytes_read / 2**20:.1f} Mo lus, {s.bytes_written / 2**20:.1f} Mo écrits{rate} [{s.status}]")
+        for s in sorted(scenes, key=lambda s: s.wall_s, reverse=True)[:top]:
+            logging.info(f"Scène {s.scene_id} ({s.stage}) : {s.wall_s:.2f} s (CPU {s.cpu_s:.2f} s), "
+                         f"pic {s.peak_rss_mb:.0f} Mo, {s.pixels} pixels")
+        for s in self.errors():
+            logging.warning(f"Échec {s.stage}{f' {s.scene_id}' if s.scene_id else ''} : {s.error}")
+
+
+def slowest(con, run_id=None, top=SUMMARY_TOP):
+    """
+    Scènes les plus lentes d'une exécution (la dernière par défaut), d'après pipeline_metrics.
+    """
+    if run_id is None:
+        run_id = con.execute("SELECT max(run_id) FROM pipeline_metrics").fetchone()[0]
+    return con.execute("""
+        SELECT stage, scene_id, wall_s, cpu_s, peak_rss_mb, pixels
+        FROM pipeline_metrics
+        WHERE run_id = ? AND scene_id IS NOT NULL
+        ORDER BY wall_s DESC
+        LIMIT ?
+    """, (run_id, top)).fetchall()
+
+
+if __name__ == "__main__":
+    con = duckdb.connect(DB_PATH)
+    for row in slowest(con):
+        print(row)
+    con.close()
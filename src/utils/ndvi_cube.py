@@ -0,0 +1,273 @@
+import os
+import json
+import shutil
+import logging
+import calendar
+from datetime import date, datetime
+
+import duckdb
+import numpy as np
+
+from utils.incremental import create_state_table
+from utils.metrics import count_pixels
+from utils.ndvi_storage import load_ndvi
+from utils.parallel import map_scenes
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+DB_PATH = os.path.join(BASE_DIR, "bdd", "ndvi.duckdb")
+CUBE_DIR = os.path.join(BASE_DIR, "data", "ndvi_cube")
+CUBE_DTYPE = np.float32
+# Taille visée d'un bloc (time, rows, width) lu par chaque processus lors des réductions : la hauteur du bloc
+# diminue quand le nombre de dates augmente, et la mémoire par processus reste bornée quelle que soit la profondeur
+CHUNK_BYTES = 64 * 2**20
+
+# Cube temporel NDVI (time, y, x) sur disque :
+# - cube.f32 : tableau float32 brut en ordre C, une tranche (y, x) par date, ajoutée en fin de fichier ;
+# - index.json : grille commune (height, width) et liste ordonnée des (scene_id, acquisition_date, version).
+# Un ajout n'écrit que les nouvelles tranches et celles des scènes recalculées, puis réécrit l'index de façon atomique :
+# un ajout interrompu laisse au pire des octets en trop, ignorés à la lecture.
+
+
+def cube_paths(cube_dir=CUBE_DIR):
+    return os.path.join(cube_dir, "cube.f32"), os.path.join(cube_dir, "index.json")
+
+
+def load_cube_index(cube_dir=CUBE_DIR):
+    _, index_path = cube_paths(cube_dir)
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_cube_index(cube_dir, index):
+    _, index_path = cube_paths(cube_dir)
+    tmp = index_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp, index_path)
+
+
+def open_cube(cube_dir=CUBE_DIR, mode="r"):
+    """
+    Retourne (cube, index) où cube est un np.memmap (time, height, width) : aucune donnée n'est chargée.
+    """
+    index = load_cube_index(cube_dir)
+    if index is None or not index["scenes"]:
+        raise FileNotFoundError(f"Aucun cube NDVI dans {cube_dir}")
+    data_path, _ = cube_paths(cube_dir)
+    shape = (len(index["scenes"]), index["height"], index["width"])
+    return np.memmap(data_path, dtype=index["dtype"], mode=mode, shape=shape), index
+
+
+def cube_dates(index):
+    return [date.fromisoformat(scene["acquisition_date"]) for scene in index["scenes"]]
+
+
+def decimal_years(dates):
+    """
+    Dates converties en années décimales (axe de temps des tendances, en NDVI par an).
+    """
+    return np.array([d.year + (d.timetuple().tm_yday - 1) / (366 if calendar.isleap(d.year) else 365) for d in dates])
+
+
+def fit_to_grid(ndvi, height, width):
+    """
+    Aligne un NDVI sur la grille commune, centre sur centre : rognage des bords en trop, NaN pour les pixels manquants.
+    Les scènes sont des crops centrés de la même tuile WRS, de tailles légèrement différentes.
+    """
+    out = np.full((height, width), np.nan, dtype=CUBE_DTYPE)
+    src_h, src_w = ndvi.shape
+    rows, cols = min(height, src_h), min(width, src_w)
+    src_r, src_c = (src_h - rows) // 2, (src_w - cols) // 2
+    dst_r, dst_c = (height - rows) // 2, (width - cols) // 2
+    out[dst_r:dst_r + rows, dst_c:dst_c + cols] = ndvi[src_r:src_r + rows, src_c:src_c + cols]
+    return out
+
+
+def select_cube_scenes(con):
+    """
+    (scene_id, acquisition_date, height, width, version) ; version identifie le calcul NDVI enregistré
+    (empreinte et date de l'étape ndvi dans pipeline_state) : elle change à chaque recalcul de la scène.
+    """
+    create_state_table(con)
+    return con.execute("""
+        SELECT n.scene_id, d.acquisition_date, n.height, n.width, s.fingerprint || '@' || CAST(s.completed_at AS TEXT)
+        FROM standardized_ndvi n
+        LEFT JOIN (SELECT DISTINCT scene_id, acquisition_date FROM downloads) d USING (scene_id)
+        LEFT JOIN pipeline_state s ON s.stage = 'ndvi' AND s.item_id = n.scene_id
+        ORDER BY d.acquisition_date, n.scene_id
+    """).fetchall()
+
+
+def append_to_cube(con, cube_dir=CUBE_DIR, replace=False, height=None, width=None):
+    """
+    Ajoute au cube les scènes de standardized_ndvi qui n'y sont pas encore, et réécrit en place la tranche des scènes
+    recalculées depuis leur ajout (version différente de celle de l'index).
+    À la création, la grille commune est la plus petite hauteur/largeur des scènes (sauf height/width explicites) ;
+    elle reste ensuite fixe et les nouvelles dates y sont alignées par fit_to_grid.
+    """
+    if replace and os.path.exists(cube_dir):
+        shutil.rmtree(cube_dir)
+    os.makedirs(cube_dir, exist_ok=True)
+    data_path, _ = cube_paths(cube_dir)
+
+    scenes = select_cube_scenes(con)
+    index = load_cube_index(cube_dir)
+    if index is None:
+        if not scenes:
+            logging.info("Aucun NDVI à ajouter au cube.")
+            return
+        index = {
+            "height": height or min(scene[2] for scene in scenes),
+            "width": width or min(scene[3] for scene in scenes),
+            "dtype": np.dtype(CUBE_DTYPE).name,
+            "scenes": [],
+        }
+
+    positions = {scene["scene_id"]: i for i, scene in enumerate(index["scenes"])}
+    new_scenes = [scene for scene in scenes if scene[0] not in positions]
+    stale = [scene for scene in scenes
+             if scene[0] in positions and index["scenes"][positions[scene[0]]].get("version") != scene[4]]
+    if not new_scenes and not stale:
+        logging.info("Cube NDVI déjà à jour.")
+        return
+
+    slice_bytes = index["height"] * index["width"] * np.dtype(index["dtype"]).itemsize
+    with open(data_path, "r+b" if os.path.exists(data_path) else "w+b") as f:
+        # Tranches recalculées : réécrites à leur place, l'ordre du temps est inchangé
+        for scene_id, _, _, _, version in stale:
+            f.seek(positions[scene_id] * slice_bytes)
+            f.write(fit_to_grid(load_ndvi(con, scene_id), index["height"], index["width"]).tobytes())
+            index["scenes"][positions[scene_id]]["version"] = version
+            count_pixels(index["height"] * index["width"])
+
+        # Ignore les octets d'un éventuel ajout interrompu avant la mise à jour de l'index
+        f.truncate(len(index["scenes"]) * slice_bytes)
+        f.seek(0, os.SEEK_END)
+        for scene_id, acquisition_date, _, _, version in new_scenes:
+            f.write(fit_to_grid(load_ndvi(con, scene_id), index["height"], index["width"]).tobytes())
+            if acquisition_date is None:
+                acquisition_date = datetime.strptime(scene_id.split("_")[3], "%Y%m%d").date()
+            index["scenes"].append({"scene_id": scene_id, "acquisition_date": acquisition_date.isoformat(),
+                                    "version": version})
+            count_pixels(index["height"] * index["width"])
+
+    write_cube_index(cube_dir, index)
+    logging.info(f"{len(new_scenes)} date(s) ajoutée(s) et {len(stale)} date(s) recalculée(s) réécrite(s) dans le cube NDVI "
+                 f"({len(index['scenes'])} au total, grille {index['height']}x{index['width']}).")
+
+
+def chunk_rows_for(index, chunk_bytes=CHUNK_BYTES):
+    """
+    Hauteur de bloc telle que time x rows x width valeurs tiennent dans chunk_bytes (au moins une ligne).
+    """
+    row_bytes = len(index["scenes"]) * index["width"] * np.dtype(index["dtype"]).itemsize
+    return max(1, min(index["height"], chunk_bytes // max(row_bytes, 1)))
+
+
+def trend_kernel(chunk, years):
+    """
+    Pente de la régression linéaire par pixel (NDVI par an), les NaN étant exclus pixel par pixel.
+    Sommes cumulées date par date (n, St, Sy, Stt, Sty) : la mémoire de travail est de quelques tranches (rows, width),
+    sans copie du bloc. Les années sont centrées pour que Stt - St²/n ne perde pas de précision.
+    """
+    years = np.asarray(years, dtype=np.float64)
+    years = years - years.mean() if len(years) else years
+    shape = chunk.shape[1:]
+    n = np.zeros(shape, dtype=np.float64)
+    sum_t, sum_y, sum_tt, sum_ty = (np.zeros(shape, dtype=np.float64) for _ in range(4))
+    for t, layer in zip(years, chunk):
+        valid = np.isfinite(layer)
+        y = np.where(valid, layer, 0).astype(np.float64, copy=False)
+        n += valid
+        sum_t += t * valid
+        sum_tt += t * t * valid
+        sum_y += y
+        sum_ty += t * y
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sum_ty - sum_t * sum_y) / (n * sum_tt - sum_t * sum_t)
+    slope[n < 2] = np.nan
+    return slope.astype(CUBE_DTYPE)
+
+
+def mean_kernel(chunk, selected):
+    """
+    Moyenne par pixel sur les dates sélectionnées (masque booléen sur l'axe du temps), par sommes cumulées
+    date par date plutôt que par une copie des dates sélectionnées.
+    """
+    total = np.zeros(chunk.shape[1:], dtype=np.float64)
+    count = np.zeros(chunk.shape[1:], dtype=np.int32)
+    for i in np.flatnonzero(selected):
+        layer = chunk[i]
+        valid = np.isfinite(layer)
+        total += np.where(valid, layer, 0)
+        count += valid
+    # Pixels sans aucune valeur valide : NaN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (total / count).astype(CUBE_DTYPE)
+
+
+def anomaly_kernel(chunk, target, baseline):
+    return mean_kernel(chunk, target) - mean_kernel(chunk, baseline)
+
+
+def reduce_rows(row_off, cube_dir, rows, kernel, args):
+    """
+    Applique kernel à un bloc de lignes du cube ; exécutable dans un processus fils (le cube y est re-mappé).
+    Le bloc reste un np.memmap : les noyaux le parcourent date par date.
+    """
+    cube, _ = open_cube(cube_dir)
+    return row_off, kernel(cube[:, row_off:row_off + rows, :], *args)
+
+
+def reduce_cube(kernel, args=(), cube_dir=CUBE_DIR, workers=1, chunk_rows=None):
+    """
+    Réduction par blocs de lignes sur l'axe du temps : chaque bloc (time, rows, width) est traité
+    indépendamment, en parallèle si workers > 1. Retourne un tableau (height, width).
+    chunk_rows : hauteur des blocs ; par défaut déduite de CHUNK_BYTES et du nombre de dates.
+    """
+    index = load_cube_index(cube_dir)
+    if index is None:
+        raise FileNotFoundError(f"Aucun cube NDVI dans {cube_dir}")
+    height, width = index["height"], index["width"]
+    chunk_rows = chunk_rows or chunk_rows_for(index)
+    out = np.full((height, width), np.nan, dtype=CUBE_DTYPE)
+
+    tasks = [(row_off, cube_dir, min(chunk_rows, height - row_off), kernel, args) for row_off in range(0, height, chunk_rows)]
+    for row_off, result in map_scenes(reduce_rows, tasks, workers=workers, error_msg="Erreur de réduction du cube, lignes"):
+        out[row_off:row_off + result.shape[0]] = result
+    return out
+
+
+def pixel_trend(cube_dir=CUBE_DIR, workers=1):
+    """
+    Tendance linéaire du NDVI par pixel, en unités NDVI par an.
+    """
+    years = decimal_years(cube_dates(load_cube_index(cube_dir)))
+    return reduce_cube(trend_kernel, (years,), cube_dir=cube_dir, workers=workers)
+
+
+def seasonal_mean(months, cube_dir=CUBE_DIR, workers=1):
+    """
+    NDVI moyen par pixel sur les acquisitions des mois donnés (ex. (12, 1, 2) pour la saison sèche).
+    """
+    selected = np.array([d.month in months for d in cube_dates(load_cube_index(cube_dir))])
+    return reduce_cube(mean_kernel, (selected,), cube_dir=cube_dir, workers=workers)
+
+
+def anomaly(baseline, target, cube_dir=CUBE_DIR, workers=1):
+    """
+    Écart par pixel entre le NDVI moyen de la période target et celui de la période baseline.
+    Chaque période est un couple (date_debut, date_fin) inclusif.
+    """
+    dates = cube_dates(load_cube_index(cube_dir))
+    in_period = lambda period: np.array([period[0] <= d <= period[1] for d in dates])
+    return reduce_cube(anomaly_kernel, (in_period(target), in_period(baseline)), cube_dir=cube_dir, workers=workers)
+
+
+if __name__ == "__main__":
+    con = duckdb.connect(DB_PATH)
+    append_to_cube(con)
+    con.close()
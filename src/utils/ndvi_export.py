@@ -0,0 +1,102 @@
+import os
+import logging
+import duckdb
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as raster_copy
+
+from utils.incremental import create_state_table
+from utils.ndvi_storage import iter_ndvi, load_ndvi_georef
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+DB_PATH = os.path.join(BASE_DIR, "bdd", "ndvi.duckdb")
+NDVI_TIF_DIR = os.path.join(BASE_DIR, "data", "ndvi_tif")
+
+# COG : tuiles internes, prédicteur flottant, aperçus internes calculés par moyenne
+COG_COMPRESS = "DEFLATE"
+COG_LEVEL = 6
+COG_BLOCKSIZE = 512
+COG_OVERVIEW_RESAMPLING = "AVERAGE"
+# Métadonnée du COG : empreinte de l'étape ndvi (pipeline_state) du NDVI exporté, pour reconnaître un export périmé
+FINGERPRINT_TAG = "NDVI_FINGERPRINT"
+
+
+def ndvi_cog_path(scene_id, output_dir=NDVI_TIF_DIR):
+    return os.path.join(output_dir, f"{scene_id}_NDVI.tif")
+
+
+def ndvi_fingerprints(con):
+    """
+    {scene_id: empreinte de l'étape ndvi} d'après pipeline_state.
+    """
+    create_state_table(con)
+    return dict(con.execute("SELECT item_id, fingerprint FROM pipeline_state WHERE stage = 'ndvi'").fetchall())
+
+
+def cog_fingerprint(path):
+    """
+    Empreinte NDVI enregistrée dans un COG exporté (None si le fichier est absent ou sans empreinte).
+    """
+    if not os.path.exists(path):
+        return None
+    with rasterio.open(path) as src:
+        return src.tags().get(FINGERPRINT_TAG)
+
+
+def write_ndvi_cog(path, ndvi, crs, transform, compress=COG_COMPRESS, level=COG_LEVEL, blocksize=COG_BLOCKSIZE,
+                   fingerprint=None):
+    """
+    Écrit le NDVI en Cloud-Optimized GeoTIFF : tuiles blocksize x blocksize, compression DEFLATE ou ZSTD avec
+    prédicteur flottant, NaN en nodata et aperçus internes (moyenne, NaN ignorés).
+    fingerprint : empreinte de l'étape ndvi enregistrée dans les métadonnées (voir cog_fingerprint).
+    Le tableau est déjà en mémoire : le COG est produit par copie depuis un jeu de données en mémoire,
+    puis renommé pour qu'un lecteur ne voie jamais de fichier partiel.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    height, width = ndvi.shape
+    profile = dict(driver="GTiff", height=height, width=width, count=1, dtype="float32", crs=crs, transform=transform,
+                   nodata=np.nan)
+    part = path + ".part"
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as mem:
+            mem.write(np.asarray(ndvi, dtype=np.float32), 1)
+            if fingerprint is not None:
+                mem.update_tags(**{FINGERPRINT_TAG: fingerprint})
+            raster_copy(
+                mem,
+                part,
+                driver="COG",
+                COMPRESS=compress,
+                LEVEL=level,
+                PREDICTOR="FLOATING_POINT",
+                BLOCKSIZE=blocksize,
+                OVERVIEWS="AUTO",
+                RESAMPLING=COG_OVERVIEW_RESAMPLING,
+                BIGTIFF="IF_SAFER",
+            )
+    os.replace(part, path)
+    return path
+
+
+def export_ndvi_cogs(con, scene_ids=None, output_dir=NDVI_TIF_DIR, compress=COG_COMPRESS):
+    """
+    Exporte en COG les NDVI déjà enregistrés (une scène en mémoire à la fois), avec leur géoréférencement d'origine.
+    """
+    fingerprints = ndvi_fingerprints(con)
+    exported = 0
+    for scene_id, ndvi in iter_ndvi(con, scene_ids):
+        georef = load_ndvi_georef(con, scene_id)
+        if georef is None:
+            logging.warning(f"Pas de géoréférencement enregistré pour {scene_id} : export ignoré.")
+            continue
+        write_ndvi_cog(ndvi_cog_path(scene_id, output_dir), ndvi, *georef, compress=compress,
+                       fingerprint=fingerprints.get(scene_id))
+        exported += 1
+    logging.info(f"{exported} NDVI exporté(s) en COG dans {output_dir}.")
+
+
+if __name__ == "__main__":
+    con = duckdb.connect(DB_PATH)
+    export_ndvi_cogs(con)
+    con.close()
@@ -0,0 +1,147 @@
+import os
+import logging
+from functools import lru_cache
+
+import duckdb
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.image import imsave
+import rasterio
+from rasterio.enums import Resampling
+
+from utils.metrics import count_pixels
+from utils.ndvi_export import cog_fingerprint, ndvi_cog_path, ndvi_fingerprints
+from utils.ndvi_storage import load_ndvi
+from utils.parallel import map_scenes
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+DB_PATH = os.path.join(BASE_DIR, "bdd", "ndvi.duckdb")
+PNG_DIR = os.path.join(BASE_DIR, "data", "ndvi_png")
+
+NDVI_COLORMAP = "RdYlGn"
+# Plus grand côté des vignettes, en pixels
+THUMBNAIL_SIZE = 1024
+LUT_SIZE = 256
+
+
+@lru_cache(maxsize=None)
+def ndvi_lut(cmap=NDVI_COLORMAP, size=LUT_SIZE):
+    """
+    Table de couleurs RGBA uint8 : size couleurs pour NDVI dans [-1, 1], plus une entrée transparente pour les NaN.
+    """
+    lut = np.zeros((size + 1, 4), dtype=np.uint8)
+    lut[:size] = matplotlib.colormaps[cmap](np.linspace(0, 1, size), bytes=True)
+    return lut
+
+
+def colorize(ndvi, lut):
+    """
+    Colorisation vectorisée : un index de couleur par pixel, puis une seule indexation dans la table.
+    """
+    size = len(lut) - 1
+    index = np.empty(ndvi.shape, dtype=np.intp)
+    with np.errstate(invalid='ignore'):
+        np.multiply(np.clip(ndvi, -1, 1) + 1, (size - 1) / 2, out=index, casting='unsafe')
+    index[~np.isfinite(ndvi)] = size
+    return lut[index]
+
+
+def thumbnail_shape(height, width, max_size=THUMBNAIL_SIZE):
+    factor = max(1, -(-max(height, width) // max_size))
+    return -(-height // factor), -(-width // factor)
+
+
+def read_cog_thumbnail(path, max_size=THUMBNAIL_SIZE):
+    """
+    Lecture réduite d'un COG : GDAL sert la lecture depuis l'aperçu interne le plus proche, sans décoder la pleine résolution.
+    """
+    with rasterio.open(path) as src:
+        return src.read(1, out_shape=thumbnail_shape(src.height, src.width, max_size), resampling=Resampling.average)
+
+
+def downsample(ndvi, max_size=THUMBNAIL_SIZE):
+    """
+    Sous-échantillonnage par pas entier d'un NDVI en mémoire (plus proche voisin, sans copie avant la colorisation).
+    """
+    height, width = ndvi.shape
+    factor = max(1, -(-max(height, width) // max_size))
+    return ndvi[::factor, ::factor]
+
+
+def render_scene(scene_id, source, output_path, max_size=THUMBNAIL_SIZE, cmap=NDVI_COLORMAP):
+    """
+    Rend une vignette PNG ; source est le chemin d'un COG NDVI ou un tableau déjà réduit.
+    Exécutable dans un processus fils.
+    """
+    ndvi = read_cog_thumbnail(source, max_size) if isinstance(source, str) else source
+    imsave(output_path, colorize(ndvi, ndvi_lut(cmap)))
+    count_pixels(ndvi.size)
+    return scene_id, output_path
+
+
+def render_ndvi_maps(con, scene_ids=None, workers=1, max_size=THUMBNAIL_SIZE, output_dir=PNG_DIR, metrics=None):
+    """
+    Vignettes PNG de toutes les scènes de standardized_ndvi, rendues en parallèle.
+    Le COG exporté est lu via ses aperçus quand son empreinte est celle du NDVI enregistré ; sinon (COG absent ou
+    périmé) le NDVI stocké est réduit avant d'être envoyé au processus. Les tâches sont produites au fil du rendu :
+    seules celles en cours de traitement sont en mémoire.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if scene_ids is None:
+        scene_ids = [s for (s,) in con.execute("SELECT scene_id FROM standardized_ndvi ORDER BY scene_id").fetchall()]
+    fingerprints = ndvi_fingerprints(con)
+
+    def tasks():
+        for scene_id in scene_ids:
+            cog_path = ndvi_cog_path(scene_id)
+            fingerprint = fingerprints.get(scene_id)
+            if fingerprint is not None and cog_fingerprint(cog_path) == fingerprint:
+                source = cog_path
+            else:
+                source = np.ascontiguousarray(downsample(load_ndvi(con, scene_id), max_size))
+            yield scene_id, source, os.path.join(output_dir, f"{scene_id}_NDVI.png"), max_size
+
+    rendered = sum(1 for _ in map_scenes(render_scene, tasks(), workers=workers, error_msg="Erreur de rendu pour", metrics=metrics))
+    logging.info(f"{rendered} carte(s) NDVI rendue(s) dans {output_dir}.")
+
+
+def plot_ndvi_timeseries(con, output_path=None):
+    """
+    Graphique temporel du NDVI de la zone : médiane et intervalle p25-p75 par acquisition, d'après ndvi_stats.
+    """
+    output_path = output_path or os.path.join(PNG_DIR, "ndvi_timeseries.png")
+    rows = con.execute("""
+        SELECT acquisition_date, sensor, mean, median, p25, p75
+        FROM ndvi_stats
+        WHERE valid_count > 0 AND acquisition_date IS NOT NULL
+        ORDER BY acquisition_date
+    """).fetchall()
+    if not rows:
+        logging.info("Aucune statistique NDVI à tracer.")
+        return None
+
+    dates, sensors, means, medians, p25, p75 = zip(*rows)
+    fig, ax = plt.subplots(figsize=(10, 4))
+    ax.fill_between(dates, p25, p75, color="tab:green", alpha=0.2, label="p25 - p75")
+    ax.plot(dates, medians, color="tab:green", label="médiane")
+    for sensor in sorted(set(sensors)):
+        selected = [i for i, s in enumerate(sensors) if s == sensor]
+        ax.scatter([dates[i] for i in selected], [means[i] for i in selected], s=12, label=f"moyenne {sensor}")
+    ax.set_ylabel("NDVI")
+    ax.set_title("Évolution temporelle du NDVI")
+    ax.legend(loc="best", fontsize="small")
+    fig.autofmt_xdate()
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    fig.savefig(output_path, dpi=120, bbox_inches="tight")
+    plt.close(fig)
+    logging.info(f"Graphique temporel enregistré : {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    con = duckdb.connect(DB_PATH)
+    render_ndvi_maps(con)
+    plot_ndvi_timeseries(con)
+    con.close()
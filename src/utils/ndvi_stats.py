@@ -0,0 +1,117 @@
+import os
+import logging
+import duckdb
+import numpy as np
+import pyarrow as pa
+
+from utils.ndvi_storage import iter_ndvi
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+DB_PATH = os.path.join(BASE_DIR, "bdd", "ndvi.duckdb")
+
+# Percentiles enregistrés en colonnes p05, p25, ... (la médiane a sa propre colonne)
+NDVI_PERCENTILES = (5, 25, 75, 95)
+# Histogramme à pas fixe sur [-1, 1] : les histogrammes de scènes différentes s'additionnent directement
+NDVI_HIST_BINS = 20
+NDVI_HIST_RANGE = (-1.0, 1.0)
+
+
+def percentile_column(q):
+    return f"p{q:02d}"
+
+
+def create_ndvi_stats_table(con, replace=True):
+    create_mode = "CREATE OR REPLACE TABLE" if replace else "CREATE TABLE IF NOT EXISTS"
+    percentiles = ",\n".join(f"{percentile_column(q)} FLOAT" for q in NDVI_PERCENTILES)
+    con.execute(f"""
+        {create_mode} ndvi_stats (
+            scene_id TEXT PRIMARY KEY,
+            acquisition_date DATE,
+            sensor TEXT,
+            pixel_count BIGINT,
+            valid_count BIGINT,
+            mean DOUBLE,
+            std DOUBLE,
+            min FLOAT,
+            max FLOAT,
+            median FLOAT,
+            {percentiles},
+            histogram INTEGER[]
+        );
+    """)
+
+
+def compute_ndvi_stats(ndvi):
+    """
+    Statistiques d'une scène calculées pendant que le NDVI est encore en mémoire.
+    Les pixels non finis (NaN, inf) sont exclus ; les valeurs valides ne sont extraites qu'une fois,
+    et tous les percentiles (médiane comprise) sortent d'un seul appel à np.percentile.
+    """
+    values = ndvi[np.isfinite(ndvi)]
+    stats = {"pixel_count": int(ndvi.size), "valid_count": int(values.size)}
+
+    if values.size == 0:
+        stats.update({"mean": None, "std": None, "min": None, "max": None, "median": None,
+                      "histogram": [0] * NDVI_HIST_BINS})
+        stats.update({percentile_column(q): None for q in NDVI_PERCENTILES})
+        return stats
+
+    quantiles = np.percentile(values, (*NDVI_PERCENTILES, 50))
+    low, high = NDVI_HIST_RANGE
+    bins = ((values - low) * (NDVI_HIST_BINS / (high - low))).astype(np.intp)
+    np.clip(bins, 0, NDVI_HIST_BINS - 1, out=bins)
+
+    stats.update({
+        "mean": float(values.mean(dtype=np.float64)),
+        "std": float(values.std(dtype=np.float64)),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "median": float(quantiles[-1]),
+        "histogram": np.bincount(bins, minlength=NDVI_HIST_BINS).tolist(),
+    })
+    stats.update({percentile_column(q): float(v) for q, v in zip(NDVI_PERCENTILES, quantiles)})
+    return stats
+
+
+def store_ndvi_stats_batch(con, rows):
+    """
+    Écrit un lot de (scene_id, stats) dans ndvi_stats en une seule instruction.
+    La date d'acquisition et le capteur sont repris de la table downloads pour les requêtes temporelles.
+    """
+    if not rows:
+        return
+
+    columns = ["pixel_count", "valid_count", "mean", "std", "min", "max", "median",
+               *(percentile_column(q) for q in NDVI_PERCENTILES)]
+    batch = pa.table({
+        "scene_id": pa.array([scene_id for scene_id, _ in rows], pa.string()),
+        **{column: pa.array([stats[column] for _, stats in rows]) for column in columns},
+        "histogram": pa.array([stats["histogram"] for _, stats in rows], pa.list_(pa.int32())),
+    })
+
+    con.register("stats_batch", batch)
+    try:
+        con.execute(f"""
+            INSERT OR REPLACE INTO ndvi_stats
+            SELECT s.scene_id, d.acquisition_date, d.sensor, {", ".join(f"s.{c}" for c in columns)}, s.histogram
+            FROM stats_batch s
+            LEFT JOIN (SELECT DISTINCT scene_id, acquisition_date, sensor FROM downloads) d USING (scene_id)
+        """)
+    finally:
+        con.unregister("stats_batch")
+
+
+def compute_stats_from_storage(con, scene_ids=None):
+    """
+    Recalcule ndvi_stats à partir des NDVI déjà enregistrés (une scène en mémoire à la fois).
+    """
+    create_ndvi_stats_table(con, replace=scene_ids is None)
+    rows = [(scene_id, compute_ndvi_stats(ndvi)) for scene_id, ndvi in iter_ndvi(con, scene_ids)]
+    store_ndvi_stats_batch(con, rows)
+    logging.info(f"Statistiques NDVI calculées pour {len(rows)} scène(s).")
+
+
+if __name__ == "__main__":
+    con = duckdb.connect(DB_PATH)
+    compute_stats_from_storage(con)
+    con.close()
@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import pyarrow as pa
+from affine import Affine
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+NDVI_DIR = os.path.join(BASE_DIR, "data", "ndvi")
+
+# Backend par défaut : "blob" (buffer float32 brut dans DuckDB) ou "npy" (fichier externe mappable)
+NDVI_STORAGE = "blob"
+NDVI_DTYPE = np.float32
+
+
+def create_ndvi_table(con, replace=True):
+    create_mode = "CREATE OR REPLACE TABLE" if replace else "CREATE TABLE IF NOT EXISTS"
+    con.execute(f"""
+        {create_mode} standardized_ndvi (
+            scene_id TEXT PRIMARY KEY,
+            storage TEXT,
+            ndvi_blob BLOB,
+            ndvi_path TEXT,
+            dtype TEXT,
+            width INT,
+            height INT,
+            valid_count BIGINT,
+            mask_blob BLOB,
+            crs TEXT,
+            transform DOUBLE[]
+        );
+    """)
+
+
+def _blob_array(ndvi):
+    """
+    Construit une colonne Arrow BLOB qui pointe directement sur le buffer NumPy (aucune copie).
+    """
+    if ndvi is None:
+        return pa.nulls(1, pa.large_binary())
+    data = pa.py_buffer(ndvi)
+    offsets = pa.py_buffer(np.array([0, data.size], dtype=np.int64))
+    return pa.Array.from_buffers(pa.large_binary(), 1, [None, offsets, data])
+
+
+def store_ndvi_batch(con, rows, storage=NDVI_STORAGE):
+    """
+    Écrit un lot de (scene_id, ndvi) ou (scene_id, ndvi, (crs, transform)) dans standardized_ndvi en une seule instruction.
+    Les tableaux sont écrits en float32 contigu, sans passer par des listes Python.
+    Pixels masqués (NaN) : le backend "blob" n'enregistre que les valeurs valides, accompagnées du masque
+    compacté (1 bit par pixel) ; le backend "npy" garde le tableau complet (NaN compris) pour rester mappable.
+    """
+    if storage not in ("blob", "npy"):
+        raise ValueError(f"Backend de stockage NDVI inconnu : {storage}")
+    if not rows:
+        return
+
+    scene_ids, blobs, paths, widths, heights, valid_counts, masks, crss, transforms = [], [], [], [], [], [], [], [], []
+    for scene_id, ndvi, *georef in rows:
+        ndvi = np.ascontiguousarray(ndvi, dtype=NDVI_DTYPE)
+        height, width = ndvi.shape
+        valid = np.isfinite(ndvi)
+        valid_count = int(np.count_nonzero(valid))
+        masked = valid_count < ndvi.size
+
+        if storage == "blob":
+            blobs.append(_blob_array(ndvi[valid] if masked else ndvi))
+            paths.append(None)
+        else:
+            os.makedirs(NDVI_DIR, exist_ok=True)
+            path = os.path.join(NDVI_DIR, f"{scene_id}.npy")
+            np.save(path, ndvi)
+            blobs.append(_blob_array(None))
+            paths.append(path)
+
+        scene_ids.append(scene_id)
+        widths.append(width)
+        heights.append(height)
+        valid_counts.append(valid_count)
+        masks.append(_blob_array(np.packbits(valid) if masked else None))
+        crs, transform = georef[0] if georef and georef[0] else (None, None)
+        crss.append(str(crs) if crs else None)
+        transforms.append(list(transform)[:6] if transform is not None else None)
+
+    batch = pa.table({
+        "scene_id": pa.array(scene_ids, pa.string()),
+        "storage": pa.array([storage] * len(scene_ids), pa.string()),
+        "ndvi_blob": pa.chunked_array(blobs, pa.large_binary()),
+        "ndvi_path": pa.array(paths, pa.string()),
+        "dtype": pa.array([np.dtype(NDVI_DTYPE).name] * len(scene_ids), pa.string()),
+        "width": pa.array(widths, pa.int32()),
+        "height": pa.array(heights, pa.int32()),
+        "valid_count": pa.array(valid_counts, pa.int64()),
+        "mask_blob": pa.chunked_array(masks, pa.large_binary()),
+        "crs": pa.array(crss, pa.string()),
+        "transform": pa.array(transforms, pa.list_(pa.float64())),
+    })
+
+    con.register("ndvi_batch", batch)
+    try:
+        con.execute("INSERT OR REPLACE INTO standardized_ndvi SELECT * FROM ndvi_batch")
+    finally:
+        con.unregister("ndvi_batch")
+
+
+def store_ndvi(con, scene_id, ndvi, storage=NDVI_STORAGE, georef=None):
+    store_ndvi_batch(con, [(scene_id, ndvi, georef)], storage=storage)
+
+
+def _as_array(storage, blob, path, dtype, width, height, mask_blob):
+    if storage == "npy":
+        # Lecture mappée en mémoire : seules les pages réellement lues sont chargées
+        return np.load(path, mmap_mode="r")
+    values = np.frombuffer(blob, dtype=dtype)
+    if mask_blob is None:
+        # Vue en lecture seule sur le buffer retourné par DuckDB
+        return values.reshape(height, width)
+    # Scène masquée : les valeurs valides sont replacées sur la grille, NaN ailleurs
+    ndvi = np.full(height * width, np.nan, dtype=dtype)
+    ndvi[np.unpackbits(np.frombuffer(mask_blob, dtype=np.uint8), count=height * width).view(bool)] = values
+    return ndvi.reshape(height, width)
+
+
+def load_ndvi(con, scene_id):
+    """
+    Retourne le NDVI d'une scène sous forme de tableau NumPy (height, width), sans matérialiser de liste.
+    """
+    row = con.execute("""
+        SELECT storage, ndvi_blob, ndvi_path, dtype, width, height, mask_blob
+        FROM standardized_ndvi
+        WHERE scene_id = ?
+    """, (scene_id,)).fetchone()
+    if row is None:
+        raise KeyError(f"Aucun NDVI enregistré pour {scene_id}")
+    return _as_array(*row)
+
+
+def iter_ndvi(con, scene_ids=None):
+    """
+    Itère sur (scene_id, ndvi) une scène à la fois pour borner la mémoire.
+    """
+    if scene_ids is None:
+        scene_ids = [s for (s,) in con.execute("SELECT scene_id FROM standardized_ndvi ORDER BY scene_id").fetchall()]
+    for scene_id in scene_ids:
+        yield scene_id, load_ndvi(con, scene_id)
+
+
+def load_ndvi_georef(con, scene_id):
+    """
+    (crs, transform Affine) du NDVI d'une scène, ou None s'il n'a pas été enregistré.
+    """
+    row = con.execute("SELECT crs, transform FROM standardized_ndvi WHERE scene_id = ?", (scene_id,)).fetchone()
+    if row is None or row[1] is None:
+        return None
+    return row[0], Affine(*row[1])
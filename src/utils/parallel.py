@@ -0,0 +1,78 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+from utils.metrics import measured_call
+
+# Tâches soumises d'avance par processus : assez pour ne jamais laisser un processus inactif
+IN_FLIGHT_PER_WORKER = 2
+
+
+def batched(iterable, size, weight=None, max_weight=None):
+    """
+    Regroupe un itérable en listes de `size` éléments (la dernière peut être plus courte).
+    weight / max_weight : le lot est aussi émis dès que la somme des weight(élément) atteint max_weight
+    (ex. octets des tableaux NDVI conservés en mémoire).
+    """
+    batch = []
+    total = 0
+    for item in iterable:
+        batch.append(item)
+        if weight is not None:
+            total += weight(item)
+        if len(batch) >= size or (max_weight is not None and total >= max_weight):
+            yield batch
+            batch = []
+            total = 0
+    if batch:
+        yield batch
+
+
+def map_scenes(func, tasks, workers=1, error_msg="Erreur pour", metrics=None):
+    """
+    Applique func(*task) à chaque tâche et produit les résultats au fil de l'eau.
+    Le premier élément de chaque tâche est l'identifiant de scène, utilisé dans les logs d'erreur.
+    Avec workers > 1, les scènes sont réparties sur un ProcessPoolExecutor ; les écritures
+    en base restent à la charge de l'appelant, dans le processus principal.
+    Avec metrics (utils.metrics.PipelineMetrics), chaque scène est mesurée dans le processus qui la calcule,
+    y compris en cas d'échec, et enregistrée dans l'étape en cours.
+    """
+    if metrics is not None:
+        measured = ((task[0], func, task) for task in tasks)
+        for result, sample in map_scenes(measured_call, measured, workers=workers, error_msg=error_msg):
+            metrics.record_scene(sample)
+            if sample.status == "ok":
+                yield result
+            else:
+                logging.error(f"{error_msg} {sample.scene_id} : {sample.error}")
+        return
+
+    if workers <= 1:
+        for task in tasks:
+            try:
+                yield func(*task)
+            except Exception as e:
+                logging.error(f"{error_msg} {task[0]} : {e}")
+        return
+
+    # Fenêtre glissante : au plus IN_FLIGHT_PER_WORKER tâches par processus soumises à la fois, et chaque Future
+    # est oublié dès son résultat produit ; la mémoire du processus principal ne croît pas avec le nombre de scènes
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, *task): task[0] for task in islice(tasks, workers * IN_FLIGHT_PER_WORKER)}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            while done:
+                future = done.pop()
+                scene_id = futures.pop(future)
+                for task in islice(tasks, 1):
+                    futures[executor.submit(func, *task)] = task[0]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error(f"{error_msg} {scene_id} : {e}")
+                    continue
+                finally:
+                    del future
+                yield result
+                del result
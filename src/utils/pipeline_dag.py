@@ -0,0 +1,128 @@
+import os
+import logging
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+
+# Étape du pipeline :
+# - run(con) : exécution, avec un curseur DuckDB propre à l'étape (deux étapes parallèles ne partagent pas de connexion) ;
+# - depends : étapes dont les sorties sont nécessaires ;
+# - inputs / outputs : ressources lues / produites, "table:<nom>" pour une table DuckDB, sinon un chemin ;
+# - exclusive : étape lancée seule (elle occupe déjà les processus de calcul, ou en crée).
+Stage = namedtuple("Stage", ["name", "run", "depends", "inputs", "outputs", "exclusive"], defaults=((), (), (), False))
+STAGE_PARALLELISM = 3
+
+
+def topological_order(stages):
+    """
+    Noms des étapes dans un ordre compatible avec leurs dépendances (ordre de déclaration à égalité).
+    """
+    order, placed = [], set()
+    remaining = list(stages)
+    while remaining:
+        ready = [name for name in remaining if all(dep in placed for dep in stages[name].depends)]
+        if not ready:
+            raise ValueError(f"Dépendances circulaires ou inconnues entre les étapes : {remaining}")
+        for name in ready:
+            order.append(name)
+            placed.add(name)
+            remaining.remove(name)
+    return order
+
+
+def descendants(stages, name):
+    found = {name}
+    for other in topological_order(stages):
+        if found.intersection(stages[other].depends):
+            found.add(other)
+    return found
+
+
+def select_stages(stages, enabled, only=None, start=None):
+    """
+    Étapes à exécuter, dans l'ordre topologique :
+    - only : exactement ces étapes, même désactivées par la configuration ;
+    - start : cette étape puis ses descendantes activées ;
+    - sinon toutes les étapes activées.
+    Les dépendances hors sélection sont supposées déjà produites (vérifiées par leurs entrées au lancement).
+    """
+    for name in list(only or []) + ([start] if start else []):
+        if name not in stages:
+            raise ValueError(f"Étape inconnue : {name} (étapes : {', '.join(stages)})")
+    if only:
+        selected = set(only)
+    elif start:
+        selected = {name for name in descendants(stages, start) if name == start or name in enabled}
+    else:
+        selected = set(enabled)
+    return [name for name in topological_order(stages) if name in selected]
+
+
+def resource_exists(con, resource):
+    if resource.startswith("table:"):
+        return con.execute("SELECT count(*) FROM information_schema.tables WHERE table_name = ?",
+                           (resource[len("table:"):],)).fetchone()[0] > 0
+    return os.path.exists(resource)
+
+
+def missing_inputs(con, stage):
+    return [resource for resource in stage.inputs if not resource_exists(con, resource)]
+
+
+def run_stage(stage, con, metrics=None):
+    cursor = con.cursor()
+    try:
+        with metrics.stage(stage.name) if metrics is not None else nullcontext():
+            missing = missing_inputs(cursor, stage)
+            if missing:
+                raise FileNotFoundError(f"Entrée(s) manquante(s) : {', '.join(missing)}")
+            stage.run(cursor)
+    finally:
+        cursor.close()
+
+
+def run_stages(stages, selected, con, metrics=None, parallelism=STAGE_PARALLELISM):
+    """
+    Exécute les étapes sélectionnées dès que leurs dépendances sélectionnées ont réussi, jusqu'à `parallelism`
+    à la fois dans des threads (les étapes exclusives tournent seules).
+    Une étape en échec fait ignorer ses descendantes ; les branches indépendantes continuent.
+    Retourne {étape: "ok" | "error" | "skipped"}.
+    """
+    status = {}
+    pending = list(selected)
+    running = {}
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        while pending or running:
+            for name in list(pending):
+                stage = stages[name]
+                depends = [dep for dep in stage.depends if dep in selected]
+                if any(status.get(dep) in ("error", "skipped") for dep in depends):
+                    logging.warning(f"Étape {name} ignorée : une étape dont elle dépend a échoué.")
+                    status[name] = "skipped"
+                    pending.remove(name)
+                    continue
+                if not all(status.get(dep) == "ok" for dep in depends):
+                    continue
+                if running and (stage.exclusive or any(stages[other].exclusive for other in running.values())):
+                    continue
+                if len(running) >= parallelism:
+                    break
+                logging.info(f"Étape {name} : démarrage")
+                running[executor.submit(run_stage, stage, con, metrics)] = name
+                pending.remove(name)
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    status[name] = "ok"
+                    logging.info(f"Étape {name} : terminée")
+                except Exception as e:
+                    status[name] = "error"
+                    # Entrée manquante : message suffisant, sans trace
+                    logging.error(f"Étape {name} en échec : {e}", exc_info=None if isinstance(e, FileNotFoundError) else e)
+    return status
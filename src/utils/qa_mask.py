@@ -0,0 +1,47 @@
+import os
+import numpy as np
+
+# Bits de la bande QA_PIXEL (Landsat Collection 2, niveau 1 et 2)
+QA_FILL = 0
+QA_DILATED_CLOUD = 1
+QA_CIRRUS = 2
+QA_CLOUD = 3
+QA_CLOUD_SHADOW = 4
+QA_SNOW = 5
+
+# Un pixel est masqué si l'un de ces bits est levé
+QA_MASK_BITS = (QA_FILL, QA_DILATED_CLOUD, QA_CIRRUS, QA_CLOUD, QA_CLOUD_SHADOW)
+
+
+def qa_bitmask(bits=QA_MASK_BITS):
+    return sum(1 << bit for bit in bits)
+
+
+def qa_valid_mask(qa, bits=QA_MASK_BITS, out=None):
+    """
+    Masque de validité (True = pixel exploitable) : un seul ET binaire vectorisé contre l'ensemble des bits.
+    """
+    if out is None:
+        out = np.empty(qa.shape, dtype=bool)
+    np.equal(np.bitwise_and(qa, qa_bitmask(bits)), 0, out=out)
+    return out
+
+
+def pack_mask(valid):
+    """
+    Masque (height, width) compacté à 1 bit par pixel, ligne par ligne : (height, ceil(width / 8)) uint8.
+    """
+    return np.packbits(valid, axis=1)
+
+
+def unpack_mask_window(packed, window, width):
+    """
+    Dépaquette uniquement les lignes de la fenêtre, puis extrait ses colonnes.
+    """
+    rows = np.asarray(packed[window.row_off:window.row_off + window.height])
+    bits = np.unpackbits(rows, axis=1, count=width)
+    return bits[:, window.col_off:window.col_off + window.width].view(bool)
+
+
+def load_packed_mask(mask_path):
+    return np.load(mask_path, mmap_mode="r") if mask_path and os.path.exists(mask_path) else None
@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import date, datetime
+
+from src.m2m_api.filters import Filter
+from src.m2m_api.async_api import search_all_scenes
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+# Base séparée de ndvi.duckdb (qui est recréée à chaque exécution complète) ; ATTACH possible pour les jointures
+SCENES_DB_PATH = os.path.join(BASE_DIR, "bdd", "scenes.duckdb")
+
+
+def create_scene_cache_tables(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS scene_search_cache (
+            query_hash TEXT PRIMARY KEY,
+            dataset_name TEXT,
+            query TEXT,
+            start_date DATE,
+            covered_until DATE,
+            last_acquisition DATE,
+            refreshed_at TIMESTAMP
+        );
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS scene_search_results (
+            query_hash TEXT,
+            entity_id TEXT,
+            display_id TEXT,
+            acquisition_date DATE,
+            cloud_cover DOUBLE,
+            scene TEXT,
+            PRIMARY KEY(query_hash, entity_id)
+        );
+    """)
+
+
+def normalized_query(datasetName, args):
+    """
+    Filtre M2M canonique de la recherche, sans la date de fin ni la pagination (qui varient d'un rafraîchissement à l'autre).
+    """
+    args = dict(args, datasetName=datasetName, processList=['datasetName', 'sceneFilter'])
+    query = json.loads(json.dumps(Filter(args)))
+    query.get('sceneFilter', {}).get('acquisitionFilter', {}).pop('end', None)
+    return query
+
+
+def query_hash(query):
+    return hashlib.sha1(json.dumps(query, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def scene_acquisition_date(scene):
+    start = (scene.get('temporalCoverage') or {}).get('startDate')
+    if start:
+        return datetime.strptime(start[:10], "%Y-%m-%d").date()
+    # Repli : date d'acquisition contenue dans le displayId (LXSS_LLLL_PPPRRR_YYYYMMDD_...)
+    parts = scene.get('displayId', '').split('_')
+    if len(parts) > 3 and parts[3].isdigit():
+        return datetime.strptime(parts[3], "%Y%m%d").date()
+    return None
+
+
+def store_scenes(con, key, scenes):
+    rows = [(key, scene['entityId'], scene.get('displayId'), scene_acquisition_date(scene), scene.get('cloudCover'),
+             json.dumps(scene)) for scene in scenes]
+    if rows:
+        con.executemany("INSERT OR REPLACE INTO scene_search_results VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+def cached_search_scenes(con, m2m, datasetName, refresh=True, limit=None, **args):
+    """
+    scene-search avec cache DuckDB.
+    - Première recherche : toutes les pages (de maxResults scènes) sont récupérées et enregistrées.
+    - Ensuite : seule la période postérieure à la dernière acquisition connue est redemandée (si refresh=True).
+    - limit : nombre maximal de scènes retournées, les plus anciennes d'abord ; le cache garde toutes les scènes,
+      pour qu'un limit différent ne fausse pas la période couverte.
+    Retourne un dict au format de M2M.searchScenes (totalHits : nombre de scènes trouvées avant limit).
+    """
+    create_scene_cache_tables(con)
+    query = normalized_query(datasetName, args)
+    key = query_hash(query)
+    endDate = datetime.strptime(args['endDate'], "%Y-%m-%d").date() if args.get('endDate') else date.today()
+
+    cached = con.execute(
+        "SELECT covered_until, last_acquisition FROM scene_search_cache WHERE query_hash = ?", (key,)
+    ).fetchone()
+
+    if cached is None or (refresh and cached[0] < endDate):
+        searchArgs = dict(args)
+        if cached is not None:
+            # Rafraîchissement incrémental : on repart de la dernière acquisition connue (incluse, dédupliquée par entityId)
+            covered_until, last_acquisition = cached
+            searchArgs['startDate'] = (last_acquisition or covered_until).isoformat()
+        logging.info(f"scene-search {datasetName} du {searchArgs.get('startDate')} au {endDate}")
+        scenes = search_all_scenes(m2m, datasetName, **searchArgs)
+        store_scenes(con, key, scenes['results'])
+
+        last_acquisition, = con.execute(
+            "SELECT max(acquisition_date) FROM scene_search_results WHERE query_hash = ? AND acquisition_date <= ?", (key, endDate)
+        ).fetchone()
+        start_date = args.get('startDate')
+        con.execute("INSERT OR REPLACE INTO scene_search_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, datasetName, json.dumps(query, sort_keys=True), start_date, endDate, last_acquisition, datetime.now()))
+    else:
+        logging.info(f"scene-search {datasetName} servi depuis le cache ({key[:8]})")
+
+    rows = con.execute("""
+        SELECT scene FROM scene_search_results
+        WHERE query_hash = ? AND (acquisition_date IS NULL OR acquisition_date <= ?)
+        ORDER BY acquisition_date, entity_id
+    """, (key, endDate)).fetchall()
+    results = [json.loads(scene) for (scene,) in rows[:limit]]
+    if limit is not None and len(rows) > limit:
+        logging.info(f"scene-search {datasetName} : {len(rows)} scène(s) trouvée(s), limitées aux {limit} premières")
+    return {'results': results, 'recordsReturned': len(results), 'totalHits': len(rows), 'startingNumber': 1, 'nextRecord': None}
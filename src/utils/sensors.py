@@ -0,0 +1,96 @@
+import re
+from collections import namedtuple
+
+# Bandes logiques utilisées par le pipeline, associées aux fichiers de chaque capteur
+Sensor = namedtuple("Sensor", ["name", "red", "nir", "qa"])
+
+# Registre des capteurs, indexé par le préfixe de l'identifiant produit (LXSS)
+SENSORS = {
+    "LT04": Sensor("TM", "B3", "B4", "QA_PIXEL"),
+    "LT05": Sensor("TM", "B3", "B4", "QA_PIXEL"),
+    "LE07": Sensor("ETM+", "B3", "B4", "QA_PIXEL"),
+    "LC08": Sensor("OLI/TIRS", "B4", "B5", "QA_PIXEL"),
+    "LO08": Sensor("OLI", "B4", "B5", "QA_PIXEL"),
+    "LC09": Sensor("OLI-2/TIRS-2", "B4", "B5", "QA_PIXEL"),
+    "LO09": Sensor("OLI-2", "B4", "B5", "QA_PIXEL"),
+}
+LOGICAL_BANDS = ("red", "nir", "qa")
+# Préfixe des fichiers de réflectance de surface des produits de niveau 2 (ex. LC08_L2SP_..._SR_B4.TIF)
+SURFACE_REFLECTANCE_PREFIX = "SR_"
+
+# Conversion compte numérique -> réflectance par niveau de traitement Collection 2 (réflectance = DN * scale + offset).
+# Niveau 2 : constantes communes à tous les capteurs. Niveau 1 : REFLECTANCE_MULT/ADD_BAND_n du MTL ; à défaut, la
+# constante L1 ne vaut que pour les DN 16 bits d'OLI, les DN 8 bits TM/ETM+ restent alors sans mise à l'échelle.
+LEVEL_SCALING = {
+    "L1": (2.0e-5, -0.1),
+    "L2": (2.75e-5, -0.2),
+}
+L1_DEFAULT_SCALING_SENSORS = ("LC08", "LO08", "LC09", "LO09")
+
+MTL_SCALING_RE = re.compile(r"^\s*REFLECTANCE_(MULT|ADD)_BAND_(\d+)\s*=\s*([-+0-9.Ee]+)", re.MULTILINE)
+
+
+def sensor_for(scene_id):
+    """
+    Capteur d'une scène d'après le préfixe de son identifiant (None si inconnu).
+    """
+    return SENSORS.get(scene_id[:4].upper())
+
+
+def processing_level(scene_id):
+    """
+    Niveau de traitement ("L1" ou "L2") d'après le deuxième champ de l'identifiant (ex. L2SP), L1 par défaut.
+    """
+    fields = scene_id.upper().split("_")
+    return fields[1][:2] if len(fields) > 1 and fields[1][:2] in LEVEL_SCALING else "L1"
+
+
+def sensor_bands(scene_id):
+    """
+    Fichiers de bandes nécessaires à une scène : {nom de bande: bande logique}.
+    Niveau 2 : rouge et PIR sont les bandes de réflectance de surface SR_Bn, la QA garde son nom.
+    """
+    sensor = sensor_for(scene_id)
+    if sensor is None:
+        return {}
+    prefix = SURFACE_REFLECTANCE_PREFIX if processing_level(scene_id) == "L2" else ""
+    return {(prefix if logical != "qa" else "") + getattr(sensor, logical): logical for logical in LOGICAL_BANDS}
+
+
+def logical_band(scene_id, band):
+    return sensor_bands(scene_id).get(band.upper())
+
+
+def default_scaling(level, sensor=None):
+    """
+    (scale, offset) par défaut d'un niveau pour un capteur (préfixe LXSS) ; None pour un niveau 1 hors OLI.
+    """
+    level = (level or "L1")[:2].upper()
+    if level == "L2":
+        return LEVEL_SCALING["L2"]
+    if sensor is not None and sensor.upper() not in L1_DEFAULT_SCALING_SENSORS:
+        return None
+    return LEVEL_SCALING["L1"]
+
+
+def parse_mtl_scaling(text):
+    """
+    Facteurs de réflectance TOA d'un MTL de niveau 1 : {numéro de bande: (mult, add)}.
+    """
+    values = {}
+    for kind, band, value in MTL_SCALING_RE.findall(text):
+        values.setdefault(int(band), {})[kind] = float(value)
+    return {band: (v["MULT"], v["ADD"]) for band, v in values.items() if "MULT" in v and "ADD" in v}
+
+
+def band_scaling(level, band, mtl_scaling=None, sensor=None):
+    """
+    (scale, offset) d'une bande : MTL pour le niveau 1 s'il fournit la bande, sinon valeur par défaut du niveau
+    et du capteur (None : comptes numériques bruts).
+    Le MTL de niveau 2 contient aussi les facteurs de niveau 1 : il est ignoré au profit des constantes du niveau 2.
+    """
+    if (level or "L1").upper().startswith("L1") and mtl_scaling and band.upper().startswith("B"):
+        scaling = mtl_scaling.get(int(band[1:]))
+        if scaling is not None:
+            return scaling
+    return default_scaling(level, sensor)
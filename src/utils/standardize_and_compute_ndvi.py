@@ -1,56 +1,223 @@
 import os
 import duckdb
 import numpy as np
-import rasterio
+from rasterio.windows import Window
 import logging
+from contextlib import ExitStack
+
+from utils.aoi import QA_NODATA, QA_RESAMPLING, aoi_grid, footprint_window, open_on_grid
+from utils.crop_images import center_window, scene_fingerprints, select_band_pairs, select_band_scalings
+from utils.incremental import mark_completed, select_changed
+from utils.metrics import count_pixels
+from utils.ndvi_export import ndvi_cog_path, write_ndvi_cog
+from utils.ndvi_stats import compute_ndvi_stats, create_ndvi_stats_table, store_ndvi_stats_batch
+from utils.ndvi_storage import NDVI_STORAGE, create_ndvi_table, store_ndvi_batch
+from utils.parallel import batched, map_scenes
+from utils.qa_mask import QA_MASK_BITS, load_packed_mask, qa_valid_mask, unpack_mask_window
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE_DIR, "bdd", "ndvi.duckdb")
 
-def calculate_ndvi(b3, b4):
-    np.seterr(divide='ignore', invalid='ignore')
-    ndvi = (b4.astype(float) - b3.astype(float)) / (b4 + b3)
-    ndvi = np.nan_to_num(ndvi)
-    return ndvi
+# Hauteur minimale d'une fenêtre de lecture : les GeoTIFF Landsat sont souvent en bandes d'une ligne
+MIN_WINDOW_ROWS = 256
+# Scènes NDVI conservées en mémoire avant une écriture groupée : au plus BATCH_SIZE scènes et BATCH_BYTES octets
+# (une scène entière dépasse 200 Mo : le lot est alors écrit scène par scène)
+BATCH_SIZE = 8
+BATCH_BYTES = 256 * 2**20
+# Alignement des scènes : "aoi" (reprojection sur la grille de la zone d'étude) ou "crop" (fenêtre centrale)
+NDVI_ALIGN = "aoi"
 
-def standardize_and_compute_ndvi(con):
-    logging.info("Étape 3 : Calcul et standardisation du NDVI...")
+def to_reflectance(dn, scaling):
+    """
+    Comptes numériques -> réflectance (DN * scale + offset) en float32 ; inchangé si scaling est None.
+    """
+    if scaling is None:
+        return dn
+    scale, offset = scaling
+    reflectance = np.multiply(dn, np.float32(scale), dtype=np.float32)
+    reflectance += np.float32(offset)
+    return reflectance
 
-    # 🛠️ Correction ici : FLOAT[] au lieu de LIST<FLOAT>
-    con.execute("""
-        CREATE OR REPLACE TABLE standardized_ndvi (
-            scene_id TEXT PRIMARY KEY,
-            ndvi_array FLOAT[],
-            width INT,
-            height INT
-        );
-    """)
+def calculate_ndvi(red, nir, out=None, valid=None, scaling=None):
+    """
+    NDVI = (PIR - Rouge) / (PIR + Rouge), calculé en float32 directement dans `out`.
+    - scaling : ((scale, offset) rouge, (scale, offset) PIR) pour calculer le NDVI en réflectance, seule grandeur
+      comparable entre capteurs ; None = comptes numériques bruts.
+    Les pixels masqués (valid == False, ex. nuages d'après QA_PIXEL) et ceux dont la réflectance rouge ou PIR est nulle
+    ou négative (remplissage, ou offset de mise à l'échelle sur un compte faible) valent NaN : le NDVI reste dans [-1, 1].
+    Sans mise à l'échelle, un seul tableau temporaire (le dénominateur) est alloué.
+    """
+    if out is None:
+        out = np.empty(red.shape, dtype=np.float32)
+    if scaling is not None:
+        red, nir = to_reflectance(red, scaling[0]), to_reflectance(nir, scaling[1])
+    denom = np.add(nir, red, dtype=np.float32)
+    np.subtract(nir, red, out=out, dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(out, denom, out=out)
+    masked = np.less_equal(red, 0)
+    np.logical_or(masked, np.less_equal(nir, 0), out=masked)
+    if valid is not None:
+        np.logical_or(masked, np.logical_not(valid), out=masked)
+    np.copyto(out, np.nan, where=masked)
+    return out
 
-    scenes = con.execute("SELECT scene_id, b3_crop_path, b4_crop_path FROM cropped_images").fetchall()
+def ndvi_windows(height, width, block_shape, min_rows=MIN_WINDOW_ROWS):
+    """
+    Découpe la grille (height, width) en fenêtres alignées sur les blocs du raster source.
+    """
+    block_h, block_w = block_shape
+    block_h = min(block_h, height)
+    block_w = min(block_w, width)
+    if block_h < min_rows:
+        block_h = min(height, -(-min_rows // block_h) * block_h)
 
-    for scene_id, b3_crop_path, b4_crop_path in scenes:
-        try:
-            with rasterio.open(b3_crop_path) as src:
-                b3 = src.read(1)
-            with rasterio.open(b4_crop_path) as src:
-                b4 = src.read(1)
+    for row_off in range(0, height, block_h):
+        for col_off in range(0, width, block_w):
+            yield Window(col_off, row_off, min(block_w, width - col_off), min(block_h, height - row_off))
+
+def compute_ndvi_windowed(red_path, nir_path, crop_ratio=None, qa_path=None, mask_path=None, grid=None, scaling=None):
+    """
+    Calcule le NDVI bloc par bloc sans jamais charger les bandes entières, dans un tableau float32 préalloué
+    (height, width) : seuls la sortie et les tampons d'une fenêtre sont alloués, sans temporaire à l'échelle de la scène.
+    - crop_ratio : limite le calcul à la fenêtre centrale de chaque bande (crop fusionné, sans fichier intermédiaire).
+    - qa_path / mask_path : masque nuages lu dans QA_PIXEL (même fenêtre que les bandes) ou dans le masque compacté du crop.
+    - grid : bandes et QA reprojetées à la volée (WarpedVRT) sur la grille commune de la zone d'étude ; la sortie a
+      toujours la forme et le géoréférencement de la grille, et seuls les blocs couverts par la scène sont calculés.
+    - scaling : conversion en réflectance des bandes rouge/PIR (voir calculate_ndvi).
+    Retourne (ndvi, (crs, transform)) : le géoréférencement de la sortie.
+    """
+    packed_mask = load_packed_mask(mask_path)
+    with ExitStack() as stack:
+        src_red = stack.enter_context(open_on_grid(red_path, grid))
+        src_nir = stack.enter_context(open_on_grid(nir_path, grid))
+        src_qa = stack.enter_context(open_on_grid(qa_path, grid, QA_RESAMPLING, QA_NODATA)) if qa_path else None
+
+        if grid is not None:
+            # Les sources partagent la grille : seule l'emprise de la scène est lue, le reste vaut NaN
+            height, width = grid.height, grid.width
+            region = footprint_window(grid, src_red.src_dataset.crs.to_string(), tuple(src_red.src_dataset.bounds))
+            crop_red = crop_nir = crop_qa = region
+            transform = grid.transform
+        else:
+            if crop_ratio is None:
+                crop_red = Window(0, 0, src_red.width, src_red.height)
+                crop_nir = Window(0, 0, src_nir.width, src_nir.height)
+            else:
+                crop_red = center_window(src_red.height, src_red.width, crop_ratio)
+                crop_nir = center_window(src_nir.height, src_nir.width, crop_ratio)
+            if src_qa is not None:
+                crop_qa = Window(0, 0, src_qa.width, src_qa.height) if crop_ratio is None else center_window(src_qa.height, src_qa.width, crop_ratio)
+            height = min(crop_red.height, crop_nir.height)
+            width = min(crop_red.width, crop_nir.width)
+            region = Window(0, 0, width, height)
+            transform = src_red.window_transform(Window(crop_red.col_off, crop_red.row_off, width, height))
+
+        windows = list(ndvi_windows(region.height, region.width, src_red.block_shapes[0])) if region is not None else []
+        count_pixels(sum(w.height * w.width for w in windows))
+
+        max_h = max((w.height for w in windows), default=0)
+        max_w = max((w.width for w in windows), default=0)
+        red_buf = np.empty((max_h, max_w), dtype=src_red.dtypes[0])
+        nir_buf = np.empty((max_h, max_w), dtype=src_nir.dtypes[0])
+        if src_qa is not None:
+            qa_buf = np.empty((max_h, max_w), dtype=src_qa.dtypes[0])
+
+        ndvi = np.full((height, width), np.nan, dtype=np.float32) if grid is not None else np.empty((height, width), dtype=np.float32)
+
+        georef = (grid.crs if grid is not None else src_red.crs.to_string(), transform)
+        for window in windows:
+            h, w = window.height, window.width
+            red = src_red.read(1, window=offset_window(window, crop_red), out=red_buf[:h, :w])
+            nir = src_nir.read(1, window=offset_window(window, crop_nir), out=nir_buf[:h, :w])
 
-            min_height = min(b3.shape[0], b4.shape[0])
-            min_width = min(b3.shape[1], b4.shape[1])
+            valid = None
+            if src_qa is not None:
+                valid = qa_valid_mask(src_qa.read(1, window=offset_window(window, crop_qa), out=qa_buf[:h, :w]))
+            elif packed_mask is not None:
+                valid = unpack_mask_window(packed_mask, window, width=crop_red.width)
 
-            b3 = b3[:min_height, :min_width]
-            b4 = b4[:min_height, :min_width]
+            target = offset_window(window, region)
+            calculate_ndvi(red, nir, out=ndvi[target.toslices()], valid=valid, scaling=scaling)
 
-            ndvi = calculate_ndvi(b3, b4)
-            ndvi_flat = ndvi.flatten().astype(np.float32)
+    return ndvi, georef
 
-            con.execute("""
-                INSERT OR REPLACE INTO standardized_ndvi 
-                VALUES (?, ?, ?, ?)
-            """, (scene_id, ndvi_flat.tolist(), min_width, min_height))
+def offset_window(window, origin):
+    return Window(window.col_off + origin.col_off, window.row_off + origin.row_off, window.width, window.height)
 
+def compute_scene_ndvi(scene_id, red_path, nir_path, write_geotiff=False, crop_ratio=None, qa_path=None, mask_path=None, grid=None,
+                       scaling=None, fingerprint=None):
+    """
+    NDVI d'une scène, exécutable dans un processus fils : retourne (scene_id, ndvi, stats, (crs, transform)).
+    Les statistiques (et le COG si write_geotiff) sont produits tant que le tableau est en mémoire, dans le même processus ;
+    fingerprint (empreinte de l'étape ndvi) est enregistrée dans le COG.
+    """
+    ndvi, georef = compute_ndvi_windowed(red_path, nir_path, crop_ratio=crop_ratio, qa_path=qa_path, mask_path=mask_path,
+                                         grid=grid, scaling=scaling)
+    if write_geotiff:
+        write_ndvi_cog(ndvi_cog_path(scene_id), ndvi, *georef, fingerprint=fingerprint)
+    return scene_id, ndvi, compute_ndvi_stats(ndvi), georef
+
+def standardize_and_compute_ndvi(con, storage=NDVI_STORAGE, write_geotiff=False, workers=1, batch_size=BATCH_SIZE,
+                                 incremental=False, fused=False, crop_ratio=0.5, align=NDVI_ALIGN, metrics=None,
+                                 scene_ids=None, replace=None, content_hash=False):
+    logging.info("Étape 3 : Calcul et standardisation du NDVI...")
+
+    # Buffer float32 brut (BLOB ou .npy externe) au lieu d'un FLOAT[] construit via tolist()
+    replace = not incremental if replace is None else replace
+    create_ndvi_table(con, replace=replace)
+    create_ndvi_stats_table(con, replace=replace)
+
+    if align == "aoi" or fused:
+        # Grille commune ou mode fusionné : les bandes extraites sont lues directement, sans fichier intermédiaire
+        scenes = select_band_pairs(con)
+    else:
+        scenes = con.execute("SELECT scene_id, red_crop_path, nir_crop_path, mask_path FROM cropped_images").fetchall()
+    if scene_ids is not None:
+        wanted = set(scene_ids)
+        scenes = [scene for scene in scenes if scene[0] in wanted]
+
+    # Bandes rouge/PIR propres au capteur de chaque scène, converties en réflectance avant le calcul
+    scalings = select_band_scalings(con)
+    grid = aoi_grid() if align == "aoi" else None
+
+    # L'empreinte couvre aussi les paramètres du calcul : changer d'alignement, de mode ou de mise à l'échelle
+    # recalcule les scènes en mode incrémental
+    params = {"align": align, "fused": fused, "crop_ratio": crop_ratio if fused and align != "aoi" else None,
+              "grid": tuple(grid) if grid is not None else None, "qa_mask_bits": QA_MASK_BITS, "storage": storage}
+    fingerprints = scene_fingerprints(scenes, lambda scene_id: dict(params, scaling=scalings.get(scene_id)),
+                                      content_hash=content_hash)
+    if incremental:
+        changed = set(select_changed(con, "ndvi", fingerprints))
+        scenes = [scene for scene in scenes if scene[0] in changed]
+        logging.info(f"{len(scenes)} scène(s) nouvelle(s) ou modifiée(s) pour le NDVI.")
+
+    if align == "aoi":
+        logging.info(f"Grille commune {grid.width}x{grid.height} ({grid.crs}, {grid.transform.a:g} m)")
+        tasks = [(scene_id, red_path, nir_path, write_geotiff, None, qa_path, None, grid, scalings.get(scene_id),
+                  fingerprints[scene_id])
+                 for scene_id, red_path, nir_path, qa_path in scenes]
+    elif fused:
+        tasks = [(scene_id, red_path, nir_path, write_geotiff, crop_ratio, qa_path, None, None, scalings.get(scene_id),
+                  fingerprints[scene_id])
+                 for scene_id, red_path, nir_path, qa_path in scenes]
+    else:
+        tasks = [(scene_id, red_path, nir_path, write_geotiff, None, None, mask_path, None, scalings.get(scene_id),
+                  fingerprints[scene_id])
+                 for scene_id, red_path, nir_path, mask_path in scenes]
+
+    # Les calculs peuvent tourner en parallèle ; seule l'écriture DuckDB est sérialisée, par lots
+    results = map_scenes(compute_scene_ndvi, tasks, workers=workers, error_msg="Erreur NDVI pour", metrics=metrics)
+    for batch in batched(results, batch_size, weight=lambda result: result[1].nbytes, max_weight=BATCH_BYTES):
+        try:
+            store_ndvi_batch(con, [(scene_id, ndvi, georef) for scene_id, ndvi, _, georef in batch], storage=storage)
+            store_ndvi_stats_batch(con, [(scene_id, stats) for scene_id, _, stats, _ in batch])
+            mark_completed(con, "ndvi", {scene_id: fingerprints[scene_id] for scene_id, *_ in batch})
         except Exception as e:
-            logging.error(f"Erreur NDVI pour {scene_id} : {e}")
+            logging.error(f"Erreur d'écriture NDVI pour {[scene_id for scene_id, *_ in batch]} : {e}")
+            if metrics is not None:
+                for scene_id, *_ in batch:
+                    metrics.record_error(scene_id, e)
 
     logging.info("NDVI standardisé calculé.")
 
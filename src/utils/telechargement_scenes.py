@@ -1,6 +1,12 @@
 import os
 import logging
-from src.m2m_api.api import M2M
+import sys
+import argparse
+import duckdb
+from src.m2m_api.api import M2M, failed_downloads
+from src.utils.aoi import AOI_BOUNDING_BOX
+from src.utils.extraction_images import EXTRACT_DIR, extract_archive
+from src.utils.scene_search_cache import SCENES_DB_PATH, cached_search_scenes
 
 # ➔ Dynamique : on récupère automatiquement le dossier /src/
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
@@ -9,39 +15,60 @@ LANDSAT_DIR = os.path.join(BASE_DIR, "data/raw/landsat")
 # Configuration du logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-# Définition des paramètres de recherche
+# Définition des paramètres de recherche (noms attendus par src.m2m_api.filters.Filter).
+# maxResults est la taille des pages de scene-search : toutes les pages sont récupérées (voir async_api).
 params = {
     "datasetName": "landsat_tm_c2_l1",
-    "spatialFilter": {
-        "filterType": "mbr",
-        "lowerLeft": {"latitude": 8.5, "longitude": -9.5},
-        "upperRight": {"latitude": 9.8, "longitude": -8.2},
-    },
-    "temporalFilter": {"startDate": "2000-01-01", "endDate": "2024-12-31"},
-    "maxResults": 10,
-    "cloudCoverFilter": {"max": 10, "min": 0},
+    # [lon_min, lon_max, lat_min, lat_max], partagée avec la grille commune du calcul NDVI (utils.aoi)
+    "boundingBox": list(AOI_BOUNDING_BOX),
+    "startDate": "2000-01-01",
+    "endDate": "2024-12-31",
+    "maxResults": 1000,
+    "minCC": 0,
+    "maxCC": 10,
 }
+# Nombre maximal de scènes téléchargées (les plus anciennes d'abord) ; None = toutes les scènes trouvées
+SCENE_LIMIT = 10
 
-# Initialisation de l'API
-m2m = M2M()
 
-
-def main():
+def main(download_dir=LANDSAT_DIR, extract_dir=EXTRACT_DIR, limit=SCENE_LIMIT):
+    """
+    Recherche, téléchargement et extraction des scènes ; retourne {scène: erreur} pour les scènes en échec.
+    """
     print("Recherche et téléchargement des scènes")
 
+    # Initialisation de l'API (ici et non à l'import, pour que params reste importable sans authentification)
+    m2m = M2M()
+
     # Assure que le dossier existe
-    os.makedirs(LANDSAT_DIR, exist_ok=True)
+    os.makedirs(download_dir, exist_ok=True)
 
-    scenes = m2m.searchScenes(**params)
+    # Recherche servie depuis le cache DuckDB ; seule la période non couverte est redemandée à l'API
+    con = duckdb.connect(SCENES_DB_PATH)
+    try:
+        scenes = cached_search_scenes(con, m2m, limit=limit, **params)
+    finally:
+        con.close()
 
-    # On enlève download_dir car pas accepté par l'API
-    downloadMeta = m2m.retrieveScenes(params["datasetName"], scenes)
+    # Chaque archive est extraite dès qu'elle est téléchargée, sans attendre la fin du lot
+    downloadMeta = m2m.retrieveScenes(params["datasetName"], scenes, download_dir=download_dir,
+                                      on_complete=lambda meta: extract_archive(meta["local_path"], extract_dir))
 
     print("Vérification du format des fichiers téléchargés")
     logging.info(f"Fichiers téléchargés : {downloadMeta}")
 
-    return LANDSAT_DIR
+    failures = failed_downloads(downloadMeta)
+    for scene, error in failures.items():
+        logging.error(f"Échec du téléchargement de {scene} : {error}")
+    return failures
 
 
 if __name__ == "__main__":
-    main()
+    # Dossiers transmis par main.py (--raw-dir / --extract-dir) quand le téléchargement est lancé comme étape du pipeline
+    parser = argparse.ArgumentParser(description="Recherche et téléchargement M2M des scènes Landsat")
+    parser.add_argument("--download-dir", default=LANDSAT_DIR)
+    parser.add_argument("--extract-dir", default=EXTRACT_DIR)
+    parser.add_argument("--limit", type=int, default=SCENE_LIMIT, help="nombre maximal de scènes (0 = toutes)")
+    args = parser.parse_args()
+    # Code de sortie non nul si une scène a échoué : l'étape download du pipeline est alors en échec
+    sys.exit(1 if main(download_dir=args.download_dir, extract_dir=args.extract_dir, limit=args.limit or None) else 0)